@@ -0,0 +1,113 @@
+# bench/fakes.py
+"""Local stand-ins for the Telegram Bot API and the image API."""
+import asyncio
+import itertools
+import json
+import random
+import time
+from aiohttp import web
+
+class FakeTelegram:
+    def __init__(self, latency=0.0):
+        """Minimal Bot API server answering the methods the bot uses.
+
+        Every call is recorded as (monotonic time, method, params) so the
+        benchmark can see when photos and broadcast copies were delivered.
+        """
+        self.latency = latency
+        self.calls = []
+        self._message_ids = itertools.count(1)
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = None
+        self.port = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{self.port}/bot"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def count(self, method):
+        return sum(1 for _, name, _ in self.calls if name == method)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = {}
+        for key, value in (await request.post()).items():
+            try:
+                params[key] = json.loads(value)
+            except (TypeError, ValueError):
+                params[key] = value
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls.append((time.monotonic(), method, params))
+        return web.json_response({"ok": True, "result": self.result(method, params)})
+
+    def message(self, params, **fields):
+        chat_id = params.get("chat_id", 1)
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if isinstance(chat_id, int) and chat_id > 0 else "group"},
+            **fields
+        }
+
+    def result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getChatMember":
+            return {
+                "status": "member",
+                "user": {"id": params.get("user_id", 1), "is_bot": False, "first_name": "User"}
+            }
+        if method == "sendPhoto":
+            file_id = f"file-{abs(hash(params.get('photo')))}"
+            return self.message(params, photo=[
+                {"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}
+            ])
+        if method in ("sendMessage", "editMessageText"):
+            return self.message(params, text=params.get("text", ""))
+        if method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        return True
+
+class FakeImageAPI:
+    def __init__(self, latency=0.5, jitter=0.2, error_rate=0.0):
+        """Image endpoint with configurable latency and failure rate"""
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.app = web.Application()
+        self.app.router.add_get("/", self.handle)
+        self._runner = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/?img="
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.error_rate:
+            if random.random() < 0.5:
+                return web.Response(status=502, text="bad gateway")
+            return web.json_response({"status": "error"})
+        prompt = request.query.get("img", "")
+        return web.json_response({
+            "status": "success",
+            "image_link": f"https://images.example/{abs(hash(prompt))}.png"
+        })
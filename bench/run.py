@@ -0,0 +1,305 @@
+# bench/run.py
+"""Offline end-to-end benchmark for the bot.
+
+Runs the real application against local stand-ins: a fake Bot API server
+and a fake image API (bench/fakes.py), plus an in-memory Mongo or a local
+one passed with --mongo-uri. It drives synthetic updates through
+Application.process_update for /start, /gen, /refer + /claim, /redeem and
+a broadcast. For each scenario it reports updates per second, p50/p99
+handler latency and, for /gen and broadcast, p50/p99 end-to-end latency.
+
+Usage:
+    pip install mongomock-motor   # only needed without --mongo-uri
+    python bench/run.py --users 200 --gens 400 --api-latency 0.5
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def configure(args):
+    """Set the environment before Config is imported"""
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCH",
+        "BOT_MODE": "polling",
+        "OWNER_ID": "1",
+        "LOG_GROUP_ID": "-100",
+        "FORCE_JOIN_CHANNEL": "@bench",
+        "DATABASE_NAME": f"bench_{uuid.uuid4().hex[:8]}",
+        "MULTI_REPLICA": "0",
+        "METRICS_PORT": "0",
+        "GEN_WORKERS": str(args.workers),
+        "GEN_QUEUE_SIZE": str(max(args.gens, 100)),
+        "GEN_MAX_PER_USER": str(args.gens),
+        "LOG_FLUSH_INTERVAL": "0.5"
+    })
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+    if not args.respect_limits:
+        # Measure our own overhead rather than Telegram's rate limits
+        os.environ.update({
+            "OUTBOUND_GLOBAL_RATE": "100000",
+            "OUTBOUND_CHAT_RATE": "100000",
+            "OUTBOUND_CHAT_BURST": "1000",
+            "OUTBOUND_GROUP_RATE": "100000",
+            "BROADCAST_RATE": "100000",
+            "BROADCAST_CONCURRENCY": "50",
+            "FLOOD_ROLE_FACTORS": "user=0,owner=0,admin=0,whitelist=0"
+        })
+
+def use_in_memory_mongo():
+    """Swap every Database collection for a mongomock-motor one"""
+    from mongomock_motor import AsyncMongoMockClient
+    from motor.motor_asyncio import AsyncIOMotorCollection
+    import database
+
+    mock = AsyncMongoMockClient()[database.db.name]
+    for name, value in list(vars(database.db_helper).items()):
+        if isinstance(value, AsyncIOMotorCollection):
+            setattr(database.db_helper, name, mock[value.name])
+
+    async def create_usage_events():
+        pass  # mongomock has no time-series collections; a plain one does here
+    database.db_helper._create_usage_events = create_usage_events
+
+# ========================================================================
+# SYNTHETIC UPDATES
+# ========================================================================
+
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self._ids = itertools.count(1)
+
+    def message(self, user_id, text):
+        from telegram import Update
+
+        entities = []
+        if text.startswith("/"):
+            entities.append({"type": "bot_command", "offset": 0, "length": len(text.split()[0])})
+        return Update.de_json({
+            "update_id": next(self._ids),
+            "message": {
+                "message_id": next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {
+                    "id": user_id,
+                    "is_bot": False,
+                    "first_name": f"User{user_id}",
+                    "username": f"user{user_id}"
+                },
+                "text": text,
+                "entities": entities
+            }
+        }, self.bot)
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class Result:
+    def __init__(self, name):
+        self.name = name
+        self.handler = []  # Seconds per process_update
+        self.e2e = []  # Seconds until the user got their result
+        self.elapsed = 0.0
+
+    def row(self):
+        ups = len(self.handler) / self.elapsed if self.elapsed else 0
+        ms = lambda values, q: f"{percentile(values, q) * 1000:8.1f}" if values else "       -"
+        return (
+            f"{self.name:<10} {len(self.handler):>7} {ups:>9.1f} "
+            f"{ms(self.handler, 0.5)} {ms(self.handler, 0.99)} "
+            f"{ms(self.e2e, 0.5)} {ms(self.e2e, 0.99)}"
+        )
+
+async def drive(application, updates, concurrency, result):
+    """Feed updates with bounded concurrency, recording handler latency"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(update):
+        async with semaphore:
+            start = time.monotonic()
+            await application.process_update(update)
+            result.handler.append(time.monotonic() - start)
+
+    start = time.monotonic()
+    await asyncio.gather(*(one(update) for update in updates))
+    result.elapsed = time.monotonic() - start
+
+# ========================================================================
+# SCENARIOS
+# ========================================================================
+
+async def bench_start(application, factory, args):
+    result = Result("/start")
+    users = range(1, args.users + 1)
+    await drive(application, [factory.message(u, "/start") for u in users], args.concurrency, result)
+    return result
+
+async def bench_gen(application, factory, telegram, args):
+    result = Result("/gen")
+    prompts = [f"bench prompt {i}" for i in range(args.prompts)]
+    submitted = {}  # chat_id -> [submit times]
+    updates = []
+    for _ in range(args.gens):
+        user_id = random.randint(1, args.users)
+        updates.append(factory.message(user_id, f"/gen {random.choice(prompts)}"))
+        submitted.setdefault(user_id, [])
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    since = time.monotonic()
+
+    async def one(update):
+        async with semaphore:
+            start = time.monotonic()
+            submitted[update.effective_chat.id].append(start)
+            await application.process_update(update)
+            result.handler.append(time.monotonic() - start)
+
+    await asyncio.gather(*(one(update) for update in updates))
+
+    # Wait until every /gen got a photo or an error reply
+    def completions():
+        done = {}
+        for at, method, params in telegram.calls:
+            if at < since:
+                continue
+            text = params.get("text", "")
+            if method == "sendPhoto" or (method == "sendMessage" and text.startswith(("❌", "🛠"))):
+                done.setdefault(params["chat_id"], []).append(at)
+        return done
+
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        done = completions()
+        if sum(len(v) for v in done.values()) >= args.gens:
+            break
+        await asyncio.sleep(0.05)
+    result.elapsed = time.monotonic() - since
+
+    for chat_id, times in completions().items():
+        for submit, finish in zip(sorted(submitted.get(chat_id, [])), sorted(times)):
+            result.e2e.append(finish - submit)
+    return result
+
+async def bench_claim(application, factory, args):
+    from database import db_helper
+
+    result = Result("/claim")
+    half = args.users // 2
+    refer = Result("/refer")
+    await drive(application, [factory.message(u, "/refer") for u in range(1, half + 1)], args.concurrency, refer)
+    codes = [doc["code"] async for doc in db_helper.referral_codes.find({"used": False})]
+    claims = [factory.message(half + 1 + i, f"/claim {code}") for i, code in enumerate(codes)]
+    await drive(application, claims, args.concurrency, result)
+    return refer, result
+
+async def bench_redeem(application, factory, args):
+    from database import db_helper
+
+    result = Result("/redeem")
+    for i in range(args.users):
+        await db_helper.generate_credit_code(f"bench-{i}", 5, 1)
+    updates = [factory.message(i + 1, f"/redeem bench-{i}") for i in range(args.users)]
+    await drive(application, updates, args.concurrency, result)
+    return result
+
+async def bench_broadcast(application, factory, telegram, args):
+    from broadcast import broadcast_engine
+
+    result = Result("broadcast")
+    since = time.monotonic()
+    await drive(application, [factory.message(1, "/broadcast")], 1, result)
+    await drive(application, [factory.message(1, "Bench broadcast")], 1, result)
+
+    deadline = time.monotonic() + args.timeout
+    while broadcast_engine._tasks and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    result.elapsed = time.monotonic() - since
+
+    copies = sorted(at for at, method, _ in telegram.calls if method == "copyMessage" and at >= since)
+    result.e2e = [at - since for at in copies]
+    result.handler = result.handler[:1] + [0.0] * len(copies)  # Rate = copies per second
+    return result
+
+# ========================================================================
+# MAIN
+# ========================================================================
+
+async def run(args):
+    from fakes import FakeImageAPI, FakeTelegram
+
+    telegram = FakeTelegram(latency=args.tg_latency)
+    images = [
+        FakeImageAPI(latency=args.api_latency, jitter=args.api_jitter, error_rate=args.error_rate)
+        for _ in range(args.backends)
+    ]
+    base_url = await telegram.start()
+    # Config reads the endpoints when bot is first imported
+    os.environ["API_ENDPOINTS"] = ",".join([await fake.start() for fake in images])
+
+    import bot
+    if not args.mongo_uri:
+        use_in_memory_mongo()
+
+    application = bot.build_application(base_url=base_url)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    factory = UpdateFactory(application.bot)
+    results = [await bench_start(application, factory, args)]
+    results.append(await bench_gen(application, factory, telegram, args))
+    results.extend(await bench_claim(application, factory, args))
+    results.append(await bench_redeem(application, factory, args))
+    results.append(await bench_broadcast(application, factory, telegram, args))
+
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await telegram.stop()
+    for fake in images:
+        await fake.stop()
+
+    print(f"\n{'scenario':<10} {'updates':>7} {'updates/s':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'e2e p50':>8} {'e2e p99':>8}")
+    for result in results:
+        print(result.row())
+    requests = " + ".join(str(fake.requests) for fake in images)
+    print(f"\nImage API requests: {requests} for {args.gens} /gen updates")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--gens", type=int, default=400, help="/gen updates to send")
+    parser.add_argument("--prompts", type=int, default=100, help="distinct prompts (repeats hit the cache)")
+    parser.add_argument("--workers", type=int, default=8, help="GEN_WORKERS")
+    parser.add_argument("--concurrency", type=int, default=50, help="updates processed at once")
+    parser.add_argument("--api-latency", type=float, default=0.5)
+    parser.add_argument("--api-jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--backends", type=int, default=1, help="fake image API endpoints")
+    parser.add_argument("--tg-latency", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=120.0, help="max seconds to wait for results")
+    parser.add_argument("--mongo-uri", help="use this MongoDB instead of an in-memory one")
+    parser.add_argument("--respect-limits", action="store_true", help="keep Telegram and flood limits")
+    args = parser.parse_args()
+
+    configure(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
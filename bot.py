@@ -1,17 +1,28 @@
 # bot.py
 import asyncio
+import html
 import logging
 import os
-import requests
-from datetime import datetime
+from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, 
-    filters, ContextTypes, ConversationHandler, CallbackQueryHandler
+    Application, CommandHandler, MessageHandler, TypeHandler, CallbackContext, ExtBot,
+    filters, ContextTypes, ConversationHandler, CallbackQueryHandler, ApplicationHandlerStop
 )
-from telegram.error import Forbidden, BadRequest
-from config import Config
+from telegram.error import BadRequest, TelegramError
+from cache import TTLCache
+from config import Config, quota_day, reset_time
 from database import db_helper
+from image_api import image_api
+from log_sink import log_sink
+from flood import flood_control
+from usage import usage_recorder, rollup_summary
+from ratelimit import PriorityRateLimiter
+from metrics import timed, handler_latency, upstream_latency, upstream_status, mongo_latency, queue_depth, cache_stats, upstream_breaker, upstream_outstanding, flood_dropped
+from webserver import WebServer, run_webhook
+from broadcast import broadcast_engine
+from coordination import coordinator
+from generation import generation_queue, prompt_cache, serve_cached, unavailable_text, GenerationJob, QueueFull, UserBusy
 
 # Enable logging
 logging.basicConfig(
@@ -23,43 +34,144 @@ logger = logging.getLogger(__name__)
 # States for conversation
 BROADCAST = 0
 
+# Force-join results; members are re-checked rarely, non-members quickly
+membership_cache = TTLCache(Config.MEMBERSHIP_CACHE_SIZE, Config.MEMBERSHIP_TTL)
+
 async def check_channel_membership(user_id, context):
     if not Config.FORCE_JOIN_CHANNEL:
         return True
+    
+    cached = membership_cache.get(user_id)
+    if cached is not None:
+        return cached
         
     try:
         member = await context.bot.get_chat_member(
             Config.FORCE_JOIN_CHANNEL,
             user_id
         )
-        return member.status in ["member", "administrator", "creator"]
-    except:
+        is_member = member.status in ["member", "administrator", "creator"]
+    except BadRequest:
+        # User not found in the channel
+        is_member = False
+    except TelegramError as e:
+        # Transient API failure: refuse this time but don't remember it
+        logger.warning(f"Membership check failed for {user_id}: {e}")
         return False
+    
+    membership_cache.set(
+        user_id,
+        is_member,
+        ttl=Config.MEMBERSHIP_TTL if is_member else Config.MEMBERSHIP_NEGATIVE_TTL
+    )
+    return is_member
+
+def join_keyboard():
+    """Join link plus a button to re-check membership after joining"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            "Join Channel", 
+            url=f"https://t.me/{Config.FORCE_JOIN_CHANNEL.strip('@')}"
+        )],
+        [InlineKeyboardButton("✅ I've Joined", callback_data="check_join")]
+    ])
+
+class BotContext(CallbackContext[ExtBot, dict, dict, dict]):
+    """Callback context carrying the sender's user document.
+
+    load_user_context fills it once per update (group -1), so handlers and
+    role checks never fetch the user again.
+    """
+
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application, chat_id=chat_id, user_id=user_id)
+        self.sender_id = None
+        self.user_doc = None  # None if the sender hasn't used /start
+        self._membership = None
+
+    async def load_user(self, user_id):
+        self.sender_id = user_id
+        self.user_doc = await db_helper.get_user(user_id)
+
+    @property
+    def role(self):
+        return (self.user_doc or {}).get("role", "user")
+
+    async def is_member(self):
+        """Channel membership, checked at most once per update"""
+        if self._membership is None:
+            self._membership = await check_channel_membership(self.sender_id, self)
+        return self._membership
+
+    def forget_membership(self):
+        """Drop the cached answer so the next is_member() asks Telegram"""
+        membership_cache.pop(self.sender_id)
+        self._membership = None
+
+def update_kind(update):
+    """Flood control key: the command name, callback or message"""
+    if update.callback_query:
+        return "callback"
+    text = update.message.text if update.message and update.message.text else ""
+    if text.startswith("/"):
+        return text.split()[0][1:].split("@")[0].lower()
+    return "message"
+
+@timed
+async def flood_guard(update: Update, context: BotContext):
+    """Group -2: refuse updates over the sender's rate before any DB or API work"""
+    user = update.effective_user
+    if user is None:
+        return
+    
+    # Role only from memory; an uncached user is treated as a regular user
+    if user.id == Config.OWNER_ID:
+        role = "owner"
+    else:
+        role = (db_helper.user_cache.peek(user.id) or {}).get("role", "user")
+    
+    kind = update_kind(update)
+    allowed, notify = flood_control.check(user.id, kind, role)
+    if allowed:
+        return
+    
+    flood_dropped.inc(command=kind)
+    if update.callback_query:
+        await update.callback_query.answer("🐢 Slow down!")
+    elif notify and update.effective_message:
+        await update.effective_message.reply_text("🐢 You're sending commands too fast. Please slow down.")
+    raise ApplicationHandlerStop
+
+@timed
+async def load_user_context(update: Update, context: BotContext):
+    """Group -1: the single user read for this update"""
+    if update.effective_user:
+        await context.load_user(update.effective_user.id)
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def start(update: Update, context: BotContext):
     user = update.effective_user
     
     # Create user if not exists
-    existing_user = await db_helper.get_user(user.id)
+    existing_user = context.user_doc
+    if existing_user and existing_user.get("blocked"):
+        # They unblocked the bot; include them in broadcasts again
+        await db_helper.unmark_blocked(user.id)
     if not existing_user:
-        await db_helper.create_user(user.id, user.username)
+        context.user_doc = await db_helper.create_user(user.id, user.username)
         await db_helper.log_to_group(
             context.bot,
             f"#NewUser\n"
             f"ID: {user.id}\n"
             f"Username: @{user.username}\n"
-            f"Total Users: {len(await db_helper.get_all_users())}"
+            f"Total Users: {await db_helper.count_users()}"
         )
     
     # Check channel membership
-    if not await check_channel_membership(user.id, context):
-        keyboard = [[InlineKeyboardButton(
-            "Join Channel", 
-            url=f"https://t.me/{Config.FORCE_JOIN_CHANNEL.strip('@')}"
-        )]]
+    if not await context.is_member():
         await update.message.reply_text(
             "⚠️ You must join the channel to use this bot!",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=join_keyboard()
         )
         return
     
@@ -80,7 +192,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="HTML"
     )
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def help_command(update: Update, context: BotContext):
     help_text = """
 <b>📖 Available Commands:</b>
 
@@ -101,77 +214,66 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /whitelist &lt;user_id&gt; - Add unlimited user
 /rm_whitelist &lt;user_id&gt; - Remove from whitelist
 /broadcast - Broadcast message
+/usage [YYYY-MM-DD] - Generation analytics
 
 👑 <b>Owner Commands:</b>
 /add_admin &lt;user_id&gt; - Add admin
 /rm_admin &lt;user_id&gt; - Remove admin
+/metrics - Performance summary
+/indexes [migrate|audit] - Database indexes
 """
     await update.message.reply_text(help_text, parse_mode="HTML")
 
-async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def generate_image(update: Update, context: BotContext):
     user = update.effective_user
     
     # Check channel membership
-    if not await check_channel_membership(user.id, context):
+    if not await context.is_member():
         await update.message.reply_text(
             "⚠️ Please join the channel first using /start"
         )
         return
     
-    # Check permissions and limits
-    can_gen, reason = await db_helper.can_generate(user.id)
-    if not can_gen:
-        await update.message.reply_text(f"❌ {reason}")
-        return
-    
     if not context.args:
         await update.message.reply_text("⚠️ Usage: /gen &lt;your prompt&gt;")
         return
     
+    # Check limits and consume one generation in a single atomic step
+    charge, reason = await db_helper.reserve_generation(user.id, context.user_doc)
+    if not charge:
+        await update.message.reply_text(f"❌ {reason}")
+        return
+    
     query = " ".join(context.args)
-    await update.message.reply_text("🎨 Generating image...")
+    job = GenerationJob(context.bot, user, update.effective_chat.id, update.message, query, charge)
     
     try:
-        # Call API
-        response = requests.get(f"{Config.API_URL}{query}", timeout=30)
-        data = response.json()
-        
-        if data.get("status") != "success":
-            await update.message.reply_text("❌ Generation failed. Try again.")
+        # Popular prompts are answered straight from the cache
+        if await serve_cached(job):
             return
-        
-        image_url = data["image_link"].strip()
-        
-        # Send image
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=image_url,
-            caption=f"✅ <b>Generated!</b>\n\nPrompt: <code>{query}</code>",
-            parse_mode="HTML"
-        )
-        
-        # Use credit
-        await db_helper.use_credit(user.id)
-        
-        # Log to group
-        await db_helper.log_to_group(
-            context.bot,
-            f"#ImageGenerated\n"
-            f"User: {user.mention_html()}\n"
-            f"ID: {user.id}\n"
-            f"Prompt: {query}\n"
-            f"URL: {image_url}"
+        # Fail fast instead of queueing behind a dead upstream
+        if not image_api.available():
+            await job.refund()
+            await update.message.reply_text(unavailable_text(image_api.retry_in()))
+            return
+        await generation_queue.submit(job)
+    except QueueFull as e:
+        await job.refund()
+        await update.message.reply_text(
+            f"🚦 Queue full, position {e.waiting + 1}. Try again in a moment."
         )
-        
-    except Exception as e:
-        logger.error(f"Generation error: {e}")
-        await update.message.reply_text("❌ Error generating image.")
-        await db_helper.log_to_group(
-            context.bot,
-            f"#Error\nUser: {user.id}\nError: {str(e)}"
+    except UserBusy:
+        await job.refund()
+        await update.message.reply_text(
+            "⏳ You already have a generation in progress. Please wait for it to finish."
         )
+    except Exception:
+        await job.refund()
+        raise
 
-async def refer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def refer(update: Update, context: BotContext):
     user = update.effective_user
     
     code, expires_at = await db_helper.generate_referral_code(user.id)
@@ -186,7 +288,8 @@ async def refer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="HTML"
     )
 
-async def claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def claim(update: Update, context: BotContext):
     user = update.effective_user
     
     if not context.args:
@@ -194,7 +297,7 @@ async def claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     code = context.args[0]
-    success, message = await db_helper.claim_referral(code, user.id)
+    success, message = await db_helper.claim_referral(code, user.id, context.user_doc)
     
     if success:
         await update.message.reply_text(f"✅ {message}")
@@ -207,10 +310,11 @@ async def claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(f"❌ {message}")
 
-async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def info(update: Update, context: BotContext):
     """Show user's personal stats: credits, daily usage, etc."""
     user = update.effective_user
-    user_data = await db_helper.get_user(user.id)
+    user_data = context.user_doc
     
     if not user_data:
         await update.message.reply_text("❌ Use /start first!")
@@ -231,49 +335,45 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🎨 Daily Usage: {daily_used}/10\n"
         f"💰 Daily Remaining: {daily_remaining}\n"
         f"🎟️ Credit Balance: {credits}\n\n"
-        f"📅 Last Reset: {user_data.get('last_reset', 'Not set')}\n"
+        f"📅 Last Reset: {last_rollover_day or 'Not yet'}\n"
         f"🎯 Referral Claimed: {'✅ Yes' if user_data.get('has_claimed_referral') else '❌ No'}",
         parse_mode="HTML"
     )
 
-async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def stats(update: Update, context: BotContext):
     """Show bot statistics (Admin/Owner only)"""
     user = update.effective_user
     
     # Check if user is admin or owner
-    if not (await db_helper.is_admin(user.id) or await db_helper.is_owner(user.id)):
+    if not (await db_helper.is_admin(user.id, context.user_doc) or await db_helper.is_owner(user.id)):
         await update.message.reply_text(
             "❌ <b>Admin/Owner Only!</b>\n\n"
             f"Your ID: <code>{user.id}</code>\n"
-            f"Your Role: {await db_helper.get_user(user.id).get('role', 'user')}",
+            f"Your Role: {context.role}",
             parse_mode="HTML"
         )
         return
     
-    users = await db_helper.get_all_users()
-    
-    # Count roles
-    role_counts = {"user": 0, "admin": 0, "whitelist": 0}
-    for u in users:
-        role_counts[u.get("role", "user")] += 1
-    
-    # Get today's stats
-    today = datetime.now().date().isoformat()
-    active_today = list(db_helper.users.find({"last_reset": today}))
+    stats = await db_helper.get_stats()
+    role_counts = stats["roles"]
     
     await update.message.reply_text(
         f"🤖 <b>Bot Statistics</b>\n\n"
-        f"👥 Total Users: <code>{len(users)}</code>\n"
+        f"👥 Total Users: <code>{stats['total_users']}</code>\n"
         f"👤 Regular Users: <code>{role_counts['user']}</code>\n"
         f"👮 Admins: <code>{role_counts['admin']}</code>\n"
         f"⭐ Whitelisted: <code>{role_counts['whitelist']}</code>\n\n"
-        f"📊 Active Today: <code>{len(active_today)}</code>\n"
-        f"🎯 Generated Images: <code>Coming soon</code>\n\n"
-        f"📅 Date: <code>{today}</code>",
+        f"📊 Active Today: <code>{stats['active_today']}</code>\n"
+        f"🎯 Generated Images: <code>{stats['images_total']}</code> "
+        f"(today: <code>{stats['images_today']}</code>)\n\n"
+        f"🔌 Image API: <code>{format_endpoints(image_api.status())}</code>\n"
+        f"📅 Date: <code>{stats['date']}</code>",
         parse_mode="HTML"
     )
 
-async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def add_admin(update: Update, context: BotContext):
     if update.effective_user.id != Config.OWNER_ID:
         await update.message.reply_text("❌ Only owner can use this!")
         return
@@ -293,7 +393,8 @@ async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID")
 
-async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def remove_admin(update: Update, context: BotContext):
     if update.effective_user.id != Config.OWNER_ID:
         await update.message.reply_text("❌ Only owner can use this!")
         return
@@ -309,10 +410,11 @@ async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID")
 
-async def whitelist_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def whitelist_user(update: Update, context: BotContext):
     user = update.effective_user
     
-    if not (await db_helper.is_admin(user.id) or await db_helper.is_owner(user.id)):
+    if not (await db_helper.is_admin(user.id, context.user_doc) or await db_helper.is_owner(user.id)):
         await update.message.reply_text("❌ Admin only!")
         return
     
@@ -327,10 +429,11 @@ async def whitelist_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID")
 
-async def remove_whitelist(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def remove_whitelist(update: Update, context: BotContext):
     user = update.effective_user
     
-    if not (await db_helper.is_admin(user.id) or await db_helper.is_owner(user.id)):
+    if not (await db_helper.is_admin(user.id, context.user_doc) or await db_helper.is_owner(user.id)):
         await update.message.reply_text("❌ Admin only!")
         return
     
@@ -345,10 +448,11 @@ async def remove_whitelist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID")
 
-async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def broadcast_start(update: Update, context: BotContext):
     user = update.effective_user
     
-    if not (await db_helper.is_admin(user.id) or await db_helper.is_owner(user.id)):
+    if not (await db_helper.is_admin(user.id, context.user_doc) or await db_helper.is_owner(user.id)):
         await update.message.reply_text("❌ Admin only!")
         return
     
@@ -358,56 +462,38 @@ async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return BROADCAST
 
-async def broadcast_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def broadcast_receive(update: Update, context: BotContext):
     user = update.effective_user
     
-    if not (await db_helper.is_admin(user.id) or await db_helper.is_owner(user.id)):
+    if not (await db_helper.is_admin(user.id, context.user_doc) or await db_helper.is_owner(user.id)):
         return ConversationHandler.END
     
-    broadcast_msg = update.effective_message
-    users = await db_helper.get_all_users()
-    
-    success = 0
-    failed = 0
-    
-    await update.message.reply_text(f"📤 Broadcasting to {len(users)} users...")
-    
-    for user_doc in users:
-        try:
-            await broadcast_msg.copy(user_doc["user_id"])
-            success += 1
-            await asyncio.sleep(0.05)  # Avoid flood limits
-        except (Forbidden, BadRequest):
-            failed += 1
-        except Exception as e:
-            logger.error(f"Broadcast error: {e}")
-            failed += 1
-    
-    await update.message.reply_text(
-        f"✅ Broadcast Complete!\n"
-        f"📤 Sent: {success}\n"
-        f"❌ Failed: {failed}"
+    progress = await update.message.reply_text(
+        f"📤 Broadcasting to {await db_helper.count_users()} users..."
     )
     
-    await db_helper.log_to_group(
+    # Runs in the background; progress is edited into the message above
+    await broadcast_engine.start(
         context.bot,
-        f"#Broadcast\n"
-        f"By: {user.mention_html()}\n"
-        f"Sent: {success}\n"
-        f"Failed: {failed}"
+        update.effective_message,
+        progress,
+        user.mention_html()
     )
     
     return ConversationHandler.END
 
-async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def broadcast_cancel(update: Update, context: BotContext):
     await update.message.reply_text("❌ Broadcast cancelled")
     return ConversationHandler.END
 
-async def generate_credit_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def generate_credit_code(update: Update, context: BotContext):
     """Generate a credit code: /gencode <amount> <code>"""
     user = update.effective_user
     
-    if not (await db_helper.is_admin(user.id) or await db_helper.is_owner(user.id)):
+    if not (await db_helper.is_admin(user.id, context.user_doc) or await db_helper.is_owner(user.id)):
         await update.message.reply_text("❌ Admin/Owner only!")
         return
     
@@ -444,7 +530,8 @@ async def generate_credit_code(update: Update, context: ContextTypes.DEFAULT_TYP
     except Exception as e:
         await update.message.reply_text(f"❌ Error: Code already exists")
 
-async def redeem_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def redeem_code(update: Update, context: BotContext):
     """Redeem a credit code: /redeem <code>"""
     user = update.effective_user
     
@@ -467,7 +554,8 @@ async def redeem_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(f"❌ {message}")
 
-async def myid(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def myid(update: Update, context: BotContext):
     """Get your Telegram user ID"""
     user = update.effective_user
     await update.message.reply_text(
@@ -477,7 +565,8 @@ async def myid(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="HTML"
     )
 
-async def debug_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def debug_config(update: Update, context: BotContext):
     """Debug: Show current configuration values"""
     user = update.effective_user
     
@@ -486,6 +575,8 @@ async def debug_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Owner only!")
         return
     
+    membership = membership_cache.stats()
+    users = db_helper.user_cache.stats()
     await update.message.reply_text(
         f"🔧 <b>Configuration Debug</b>\n\n"
         f"OWNER_ID: <code>{Config.OWNER_ID}</code>\n"
@@ -494,11 +585,161 @@ async def debug_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"LOG_GROUP_ID: <code>{Config.LOG_GROUP_ID}</code>\n"
         f"FORCE_JOIN: <code>{Config.FORCE_JOIN_CHANNEL}</code>\n"
         f"MONGO_URI: <code>{'✅ Set' if Config.MONGO_URI else '❌ Missing'}</code>\n"
-        f"Bot Token: <code>{'✅ Set' if Config.BOT_TOKEN else '❌ Missing'}</code>",
+        f"Bot Token: <code>{'✅ Set' if Config.BOT_TOKEN else '❌ Missing'}</code>\n\n"
+        f"Membership cache: <code>{membership.get('hits')} hits / "
+        f"{membership.get('misses')} misses, {membership.get('size')} entries</code>\n"
+        f"User cache: <code>{users.get('hit_ratio'):.0%} hit ratio, "
+        f"{users.get('size')}/{users.get('maxsize')} entries</code>",
         parse_mode="HTML"
     )
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def format_counts(counts):
+    return ", ".join(f"{name}={count}" for name, count in sorted(counts.items())) or "none"
+
+@timed
+async def usage_command(update: Update, context: BotContext):
+    """Admin-only generation analytics, read from the usage rollups"""
+    user = update.effective_user
+    if not (await db_helper.is_admin(user.id, context.user_doc) or await db_helper.is_owner(user.id)):
+        await update.message.reply_text("❌ Admin/Owner only!")
+        return
+    
+    day = context.args[0] if context.args else quota_day()
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+    except ValueError:
+        await update.message.reply_text("⚠️ Usage: /usage [YYYY-MM-DD]")
+        return
+    
+    summary = rollup_summary(await db_helper.get_usage_rollup("day", day))
+    if not summary:
+        await update.message.reply_text(f"📭 No generations recorded for {day}")
+        return
+    
+    lines = [
+        f"📈 <b>Usage for {day}</b>\n",
+        f"🎨 Generations: <code>{summary['total']}</code>",
+        f"⏱ Latency: <code>avg {summary['avg']:.1f}s, p50≤{summary['p50']:g}s, p95≤{summary['p95']:g}s</code>",
+        f"💾 Cache: <code>{format_counts(summary['cache'])}</code>",
+        f"🔌 Upstream: <code>{format_counts(summary['upstream'])}</code>"
+    ]
+    if day == quota_day():
+        this_hour = datetime.now(reset_time().tzinfo).strftime("%Y-%m-%dT%H")
+        hour = rollup_summary(await db_helper.get_usage_rollup("hour", this_hour))
+        if hour:
+            lines.append(f"🕐 This hour: <code>{hour['total']} generations, p95≤{hour['p95']:g}s</code>")
+    
+    top = await db_helper.get_top_prompts(day)
+    if top:
+        lines.append("\n🔥 <b>Top prompts:</b>")
+        for doc in top:
+            lines.append(f"• <code>{html.escape(doc['prompt'][:60])}</code> × {doc['count']}")
+    
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+def format_breaker(status):
+    if status["state"] == "open":
+        return f"open, probing in {status['retry_in']:.0f}s ({status['trips']} trips)"
+    return f"{status['state']} ({status['failures']} recent failures, {status['trips']} trips)"
+
+def format_endpoints(statuses):
+    up = sum(1 for status in statuses if status["state"] == "closed")
+    ejected = [html.escape(status["endpoint"]) for status in statuses if status["state"] == "open"]
+    text = f"{up}/{len(statuses)} endpoints up"
+    return f"{text}, ejected: {', '.join(ejected)}" if ejected else text
+
+def format_summary(histogram, key):
+    summary = histogram.summary(key)
+    if not summary:
+        return "no data"
+    count, mean, p50, p95, p99 = summary
+    return f"n={count} avg={mean * 1000:.0f}ms p50≤{p50 * 1000:.0f}ms p95≤{p95 * 1000:.0f}ms"
+
+@timed
+async def metrics_command(update: Update, context: BotContext):
+    """Owner-only performance summary (full data on the /metrics endpoint)"""
+    if update.effective_user.id != Config.OWNER_ID:
+        await update.message.reply_text("❌ Owner only!")
+        return
+    
+    lines = ["📈 <b>Performance Summary</b>\n", "<b>Handlers:</b>"]
+    for key in sorted(handler_latency.snapshot()):
+        lines.append(f"• {key[0]}: <code>{format_summary(handler_latency, key)}</code>")
+    
+    lines.append("\n<b>Image API:</b>")
+    for key in sorted(upstream_latency.snapshot()):
+        lines.append(f"• {key[0]}: <code>{format_summary(upstream_latency, key)}</code>")
+    statuses = ", ".join(f"{key[1]}={value}" for key, value in sorted(upstream_status.values().items()))
+    lines.append(f"• status: <code>{statuses or 'no data'}</code>")
+    for api in image_api.status():
+        hedge = f"{api['hedge_delay']:.1f}s" if api["hedge_delay"] is not None else "off"
+        lines.append(
+            f"• {html.escape(api['endpoint'])} (weight {api['weight']:g}): <code>{format_breaker(api)}, "
+            f"{api['outstanding']} in flight, timeout {api['timeout']:.1f}s, hedge after {hedge}</code>"
+        )
+    
+    dropped = ", ".join(f"{key[0]}={value}" for key, value in sorted(flood_dropped.values().items()))
+    lines.append(f"\n<b>Flood control:</b> <code>{dropped or 'nothing dropped'}</code>")
+    
+    lines.append("\n<b>MongoDB (slowest p95):</b>")
+    mongo = sorted(
+        mongo_latency.snapshot(),
+        key=lambda key: mongo_latency.summary(key)[3],
+        reverse=True
+    )
+    for key in mongo[:5]:
+        lines.append(f"• {key[0]}: <code>{format_summary(mongo_latency, key)}</code>")
+    
+    lines.append("\n<b>Queues:</b>")
+    for key, value in sorted(queue_depth.values().items()):
+        lines.append(f"• {key[0]}: <code>{value}</code>")
+    
+    lines.append("\n<b>Caches:</b>")
+    for name, cache in caches().items():
+        stats = cache.stats()
+        lines.append(f"• {name}: <code>{stats['hit_ratio']:.0%} hits, {stats['size']} entries</code>")
+    
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+@timed
+async def indexes_command(update: Update, context: BotContext):
+    """Owner-only index registry tools: status, migrate [prune], audit"""
+    if update.effective_user.id != Config.OWNER_ID:
+        await update.message.reply_text("❌ Owner only!")
+        return
+    
+    action = context.args[0] if context.args else "status"
+    if action == "status":
+        title = "🗂 <b>Index Status</b>"
+        rows = await db_helper.index_status()
+    elif action == "migrate":
+        title = "🗂 <b>Index Migration</b>"
+        rows = await db_helper.migrate_indexes(prune=context.args[1:] == ["prune"])
+        await db_helper.log_to_group(
+            context.bot,
+            f"#IndexMigration\nBy: {update.effective_user.id}\n"
+            f"Changes: {sum(1 for row in rows if row[2] not in ('ok', 'extra'))}"
+        )
+    elif action == "audit":
+        lines = ["🔎 <b>Query Plan Audit</b>\n"]
+        for method, collection, indexes, verdict in await db_helper.audit_queries():
+            icon = "⚠️" if verdict == "COLLSCAN" else "•"
+            used = ", ".join(indexes) or "no index"
+            lines.append(f"{icon} {method} ({collection}): <code>{verdict}, {used}</code>")
+        await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+        return
+    else:
+        await update.message.reply_text("⚠️ Usage: /indexes [status | migrate [prune] | audit]")
+        return
+    
+    lines = [title + "\n"]
+    for collection, index, state in rows:
+        icon = "•" if state in ("ok", "created", "rebuilt", "dropped") else "⚠️"
+        lines.append(f"{icon} {collection}.{index}: <code>{html.escape(state)}</code>")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+@timed
+async def button_handler(update: Update, context: BotContext):
     query = update.callback_query
     await query.answer()
     
@@ -508,8 +749,18 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await info(update, context)
     elif query.data == "refer":
         await refer(update, context)
+    elif query.data == "check_join":
+        # Forget the old answer so a fresh join is seen immediately
+        context.forget_membership()
+        if await context.is_member():
+            await query.message.reply_text("✅ Thanks for joining! Use /help to get started.")
+        else:
+            await query.message.reply_text(
+                "⚠️ You haven't joined yet!",
+                reply_markup=join_keyboard()
+            )
 
-async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def error_handler(update: Update, context: BotContext):
     logger.error(f"Update {update} caused error {context.error}")
     if update and update.effective_user:
         await db_helper.log_to_group(
@@ -519,10 +770,202 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Error: {str(context.error)}"
         )
 
-def main():
-    application = Application.builder().token(Config.BOT_TOKEN).build()
+async def reconcile_counters(context: BotContext):
+    """Periodic job: correct drift in the maintained user counter"""
+    await db_helper.reconcile_user_count()
+
+async def probe_backends(context: BotContext):
+    """Periodic job: eject unhealthy image endpoints, re-admit recovered ones"""
+    await image_api.probe_all()
+
+# The scheduled run and the catch-up check can fire together; the lease
+# only keeps replicas apart, so this keeps them apart within one process
+rollover_lock = asyncio.Lock()
+# Quota day of the last rollover, for /info; loaded in post_init and kept
+# current by daily_rollover (including rollovers done by other replicas)
+last_rollover_day = None
+
+async def daily_rollover(context: BotContext):
+    """Daily job (and startup catch-up): archive and zero daily quotas"""
+    global last_rollover_day
+    if rollover_lock.locked():
+        return  # Already running in this process
+    async with rollover_lock:
+        new_day = quota_day()
+        last_rollover_day = await db_helper.get_rollover_day()
+        if last_rollover_day == new_day:
+            return
+        
+        holder = coordinator.new_holder()
+        if not await coordinator.acquire("rollover", holder):
+            return  # Another replica is doing it
+        try:
+            # Re-check under the lease: another replica may have just finished
+            closed_day = await db_helper.get_rollover_day()
+            if closed_day == new_day:
+                last_rollover_day = new_day
+                return
+            if closed_day is None:
+                closed_day = quota_day(datetime.now(reset_time().tzinfo) - timedelta(days=1))
+            start = datetime.now()
+            reset = await db_helper.rollover_daily(closed_day, new_day, Config.DAILY_RESET_CHUNK)
+            await db_helper.set_rollover_day(new_day)
+            last_rollover_day = new_day
+            logger.info(
+                f"Daily rollover {closed_day} -> {new_day}: {reset} users reset "
+                f"in {(datetime.now() - start).total_seconds():.1f}s"
+            )
+        finally:
+            await coordinator.release("rollover", holder)
+
+async def resume_broadcasts(context: BotContext):
+    """Periodic job (multi-replica): take over broadcasts of dead replicas"""
+    await broadcast_engine.resume_all(context.bot)
+
+def invalidate_user(change):
+    """Drop a user another replica changed from this replica's cache"""
+    user_id = (change.get("fullDocument") or {}).get("user_id")
+    if user_id is not None:
+        db_helper.user_cache.pop(user_id)
+
+def invalidate_prompt(change):
+    key = (change.get("documentKey") or {}).get("_id")
+    if key is None:
+        # drop/rename/invalidate events: every cached entry may be gone
+        prompt_cache.memory.clear()
+    else:
+        prompt_cache.memory.pop(key)
+
+def caches():
+    """In-process caches reported in metrics"""
+    return {
+        "membership": membership_cache,
+        "user": db_helper.user_cache,
+        "prompt": prompt_cache.memory
+    }
+
+def register_gauges(application):
+    """Expose queue depths and cache counters through the metrics registry"""
+    queue_depth.callback = lambda: {
+        ("updates",): application.update_queue.qsize(),
+        ("generation",): generation_queue.depth(),
+        ("log",): log_sink.depth(),
+        ("counters",): db_helper.write_behind.depth(),
+        ("usage",): usage_recorder.depth()
+    }
+    
+    def cache_values():
+        values = {}
+        for name, cache in caches().items():
+            stats = cache.stats()
+            for stat in ("hits", "misses", "size"):
+                values[(name, stat)] = stats[stat]
+        return values
+    cache_stats.callback = cache_values
+    
+    levels = {"closed": 0, "half_open": 1, "open": 2}
+    upstream_breaker.callback = lambda: {
+        (backend.name,): levels[backend.breaker.state] for backend in image_api.backends
+    }
+    upstream_outstanding.callback = lambda: {
+        (backend.name,): backend.outstanding for backend in image_api.backends
+    }
+
+# Standalone /metrics server for polling mode (webhook mode serves it itself)
+metrics_server = None
+
+async def post_init(application: Application):
+    """Prepare the database once the event loop is running"""
+    global metrics_server, last_rollover_day
+    register_gauges(application)
+    if Config.BOT_MODE != "webhook" and Config.METRICS_PORT:
+        metrics_server = WebServer(application, Config.WEBHOOK_HOST, Config.METRICS_PORT)
+        await metrics_server.start()
+    await db_helper.setup()
+    last_rollover_day = await db_helper.get_rollover_day()
+    await db_helper.write_behind.start()
+    await usage_recorder.start()
+    await log_sink.start(application.bot)
+    application.job_queue.run_repeating(
+        reconcile_counters,
+        interval=Config.COUNTER_RECONCILE_INTERVAL,
+        first=0
+    )
+    # Reset at the configured time; the repeating check catches up on a
+    # reset missed while down and retries one that failed (it is a no-op
+    # once the day has rolled over)
+    application.job_queue.run_daily(daily_rollover, time=reset_time())
+    application.job_queue.run_repeating(
+        daily_rollover,
+        interval=Config.DAILY_RESET_RETRY_INTERVAL,
+        first=0
+    )
+    if Config.API_PROBE_INTERVAL:
+        application.job_queue.run_repeating(
+            probe_backends,
+            interval=Config.API_PROBE_INTERVAL,
+            first=Config.API_PROBE_INTERVAL
+        )
+    await generation_queue.start()
+    await broadcast_engine.resume_all(application.bot)
+    
+    if coordinator.enabled:
+        coordinator.subscribe(db_helper.users, invalidate_user, full_document="updateLookup")
+        coordinator.subscribe(db_helper.prompt_cache, invalidate_prompt)
+        await coordinator.start()
+        application.job_queue.run_repeating(
+            resume_broadcasts,
+            interval=Config.LEASE_TTL,
+            first=Config.LEASE_TTL
+        )
+
+async def post_stop(application: Application):
+    """Stop background work while the bot can still send the last logs"""
+    await generation_queue.stop()
+    await broadcast_engine.stop()
+    # Write the last batched quota changes and usage events
+    await db_helper.write_behind.stop()
+    await usage_recorder.stop()
+    await log_sink.stop()
+    await coordinator.stop()
+
+async def post_shutdown(application: Application):
+    """Release pooled connections when the bot stops"""
+    await image_api.close()
+    if metrics_server:
+        await metrics_server.stop()
+
+def build_application(base_url=None):
+    """Create the application with all handlers (base_url: alternative Bot API server)"""
+    builder = (
+        Application.builder()
+        .token(Config.BOT_TOKEN)
+        .rate_limiter(PriorityRateLimiter(
+            global_rate=Config.OUTBOUND_GLOBAL_RATE,
+            chat_rate=Config.OUTBOUND_CHAT_RATE,
+            chat_burst=Config.OUTBOUND_CHAT_BURST,
+            group_rate=Config.OUTBOUND_GROUP_RATE,
+            max_retries=Config.OUTBOUND_MAX_RETRIES
+        ))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(Config.CONCURRENT_UPDATES)
+        .context_types(ContextTypes(context=BotContext))
+    )
+    if Config.BOT_MODE == "webhook":
+        # Updates arrive through our own web server instead of getUpdates
+        builder.updater(None)
+    if base_url:
+        builder.base_url(base_url)
+    application = builder.build()
     
     # User commands
+    # Flood control runs first and stops refused updates
+    application.add_handler(TypeHandler(Update, flood_guard), group=-2)
+    # Then the sender's user document is loaded once for all handlers
+    application.add_handler(TypeHandler(Update, load_user_context), group=-1)
+    
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("gen", generate_image))
@@ -530,6 +973,8 @@ def main():
     application.add_handler(CommandHandler("redeem", redeem_code))
     application.add_handler(CommandHandler("myid", myid))
     application.add_handler(CommandHandler("debug_config", debug_config))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    application.add_handler(CommandHandler("indexes", indexes_command))
     application.add_handler(CommandHandler("refer", refer))
     application.add_handler(CommandHandler("claim", claim))
     application.add_handler(CommandHandler("info", info))
@@ -540,6 +985,7 @@ def main():
     
     # Admin/Owner commands
     application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("usage", usage_command))
     application.add_handler(CommandHandler("whitelist", whitelist_user))
     application.add_handler(CommandHandler("rm_whitelist", remove_whitelist))
     
@@ -556,9 +1002,15 @@ def main():
     
     # Error handler
     application.add_error_handler(error_handler)
-    
+    return application
+
+def main():
+    application = build_application()
     print(f"🚀 Bot started! Owner ID: {Config.OWNER_ID}")
-    application.run_polling()
+    if Config.BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,172 @@
+# broadcast.py
+import asyncio
+import logging
+import time
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from config import Config
+from coordination import coordinator
+from database import db_helper
+from ratelimit import PRIORITY_BULK, TokenBucket, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+class BroadcastEngine:
+    def __init__(self, rate, concurrency, batch_size, progress_interval):
+        """Send broadcasts in the background at a bounded global rate.
+
+        Recipients are streamed from Mongo in user_id order and sent in
+        batches; after each batch the position is saved so a restarted
+        bot resumes from the last completed batch.
+        """
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self._tasks = {}  # broadcast id -> task
+
+    async def start(self, bot, message, progress_message, by_html):
+        """Create a broadcast of `message` and run it in the background"""
+        broadcast = await db_helper.create_broadcast({
+            "from_chat_id": message.chat_id,
+            "message_id": message.message_id,
+            "progress_chat_id": progress_message.chat_id,
+            "progress_message_id": progress_message.message_id,
+            "by": by_html
+        })
+        self._spawn(bot, broadcast)
+        return broadcast["_id"]
+
+    async def resume_all(self, bot):
+        """Restart broadcasts interrupted by a crash or restart.
+
+        In multi-replica mode this runs periodically; the broadcast lease
+        makes sure only one replica picks each broadcast up.
+        """
+        for broadcast in await db_helper.get_running_broadcasts():
+            if broadcast["_id"] in self._tasks:
+                continue
+            logger.info(f"Resuming broadcast {broadcast['_id']} after user {broadcast['last_user_id']}")
+            self._spawn(bot, broadcast)
+
+    async def stop(self):
+        """Cancel running broadcasts; they stay 'running' and resume on start"""
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    def _spawn(self, bot, broadcast):
+        task = asyncio.create_task(self._run(bot, broadcast))
+        self._tasks[broadcast["_id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast["_id"], None))
+
+    # ========================================================================
+    # SENDING
+    # ========================================================================
+
+    async def _send(self, bot, broadcast, user_id, counts, semaphore):
+        async with semaphore:
+            while True:
+                await self.bucket.acquire()
+                try:
+                    await bot.copy_message(
+                        user_id,
+                        broadcast["from_chat_id"],
+                        broadcast["message_id"],
+                        rate_limit_args={"priority": PRIORITY_BULK}
+                    )
+                    counts["sent"] += 1
+                    return
+                except RetryAfter as e:
+                    # The outbound limiter gave up retrying; slow the broadcast down
+                    self.bucket.pause(retry_after_seconds(e))
+                except Forbidden:
+                    # Blocked or deactivated: skip this user in later broadcasts
+                    await db_helper.mark_blocked(user_id)
+                    counts["blocked"] += 1
+                    return
+                except BadRequest:
+                    counts["failed"] += 1
+                    return
+                except Exception as e:
+                    logger.error(f"Broadcast error: {e}")
+                    counts["failed"] += 1
+                    return
+
+    async def _run(self, bot, broadcast):
+        lease = f"broadcast:{broadcast['_id']}"
+        holder = coordinator.new_holder()
+        if not await coordinator.acquire(lease, holder):
+            return  # Another replica is sending it
+        try:
+            await self._send_all(bot, broadcast, lease, holder)
+        finally:
+            await coordinator.release(lease, holder)
+
+    async def _send_all(self, bot, broadcast, lease, holder):
+        counts = {key: broadcast.get(key, 0) for key in ("sent", "failed", "blocked")}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        last_report = time.monotonic()
+
+        batch = []
+        async for user_id in db_helper.iter_broadcast_recipients(
+            broadcast["last_user_id"], self.batch_size
+        ):
+            batch.append(user_id)
+            if len(batch) < self.batch_size:
+                continue
+
+            await self._send_batch(bot, broadcast, batch, counts, semaphore)
+            batch = []
+            if not await coordinator.acquire(lease, holder):
+                logger.warning(f"Lost lease on broadcast {broadcast['_id']}, stopping")
+                return
+            if time.monotonic() - last_report >= self.progress_interval:
+                last_report = time.monotonic()
+                await self._report(bot, broadcast, counts, "📤 Broadcasting...")
+
+        if batch:
+            await self._send_batch(bot, broadcast, batch, counts, semaphore)
+        await db_helper.finish_broadcast(broadcast["_id"], counts)
+
+        await self._report(bot, broadcast, counts, "✅ Broadcast Complete!")
+        await db_helper.log_to_group(
+            bot,
+            f"#Broadcast\n"
+            f"By: {broadcast['by']}\n"
+            f"Sent: {counts['sent']}\n"
+            f"Failed: {counts['failed']}\n"
+            f"Blocked: {counts['blocked']}"
+        )
+
+    async def _send_batch(self, bot, broadcast, batch, counts, semaphore):
+        await asyncio.gather(*(
+            self._send(bot, broadcast, user_id, counts, semaphore) for user_id in batch
+        ))
+        broadcast["last_user_id"] = batch[-1]
+        await db_helper.save_broadcast_progress(broadcast["_id"], batch[-1], counts)
+
+    async def _report(self, bot, broadcast, counts, title):
+        """Edit the admin's progress message"""
+        try:
+            await bot.edit_message_text(
+                f"{title}\n"
+                f"📤 Sent: {counts['sent']}\n"
+                f"❌ Failed: {counts['failed']}\n"
+                f"🚫 Blocked: {counts['blocked']}",
+                chat_id=broadcast["progress_chat_id"],
+                message_id=broadcast["progress_message_id"],
+                rate_limit_args={"priority": PRIORITY_BULK}
+            )
+        except Exception as e:
+            logger.warning(f"Broadcast progress edit failed: {e}")
+
+# ========================================================================
+# CREATE GLOBAL INSTANCE
+# ========================================================================
+broadcast_engine = BroadcastEngine(
+    rate=Config.BROADCAST_RATE,
+    concurrency=Config.BROADCAST_CONCURRENCY,
+    batch_size=Config.BROADCAST_BATCH_SIZE,
+    progress_interval=Config.BROADCAST_PROGRESS_INTERVAL
+)
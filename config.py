@@ -1,5 +1,8 @@
 # config.py
 import os
+import socket
+from datetime import datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,25 +16,172 @@ def get_int_env(key: str, default: int = 0) -> int:
         print(f"⚠️  Invalid {key}: '{value}'. Using default: {default}")
         return default
 
+def get_float_env(key: str, default: float = 0.0) -> float:
+    """Safely get float environment variable"""
+    value = os.getenv(key)
+    try:
+        return float(value) if value else default
+    except (ValueError, TypeError):
+        print(f"⚠️  Invalid {key}: '{value}'. Using default: {default}")
+        return default
+
+def get_bool_env(key: str, default: bool = False) -> bool:
+    """Safely get boolean environment variable (1/true/yes/on)"""
+    value = os.getenv(key)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def get_endpoints_env(key: str, default_url: str) -> list:
+    """Parse "url|weight|type|health_url, ..." into (url, weight, type,
+    health_url) tuples.
+
+    Weight defaults to 1 and type to "http"; invalid weights fall back to 1.
+    Without a health URL the endpoint is not actively probed.
+    """
+    value = os.getenv(key)
+    if not value:
+        return [(default_url, 1.0, "http", None)]
+    endpoints = []
+    for entry in value.split(","):
+        parts = [part.strip() for part in entry.split("|")]
+        if not parts[0]:
+            continue
+        weight = 1.0
+        if len(parts) > 1 and parts[1]:
+            try:
+                weight = float(parts[1])
+            except ValueError:
+                print(f"⚠️  Invalid weight in {key}: '{parts[1]}'. Using 1")
+        endpoints.append((
+            parts[0],
+            weight if weight > 0 else 1.0,
+            parts[2] if len(parts) > 2 and parts[2] else "http",
+            parts[3] if len(parts) > 3 and parts[3] else None
+        ))
+    return endpoints
+
+def get_mapping_env(key: str, default: str = "") -> dict:
+    """Parse "name=value,name=value" into a dict of strings"""
+    mapping = {}
+    for entry in (os.getenv(key) or default).split(","):
+        name, sep, value = entry.partition("=")
+        if not sep or not name.strip():
+            if entry.strip():
+                print(f"⚠️  Ignoring invalid {key} entry: '{entry.strip()}'")
+            continue
+        mapping[name.strip().lower()] = value.strip()
+    return mapping
+
 class Config:
     # Bot Configuration
     BOT_TOKEN = os.getenv("BOT_TOKEN")
+    BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling or webhook
+    CONCURRENT_UPDATES = get_int_env("CONCURRENT_UPDATES", 1)  # Updates handled in parallel
+    
+    # Webhook mode
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Public base URL, e.g. https://bot.example.com
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Checked against Telegram's header
+    WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    PORT = get_int_env("PORT", 8080)
+    WEBHOOK_MAX_CONNECTIONS = get_int_env("WEBHOOK_MAX_CONNECTIONS", 40)
+    METRICS_PORT = get_int_env("METRICS_PORT", 0)  # /metrics server in polling mode; 0 = off
+    
+    # Multi-replica mode (shared quota, queue slots and cache invalidation)
+    MULTI_REPLICA = get_bool_env("MULTI_REPLICA", False)
+    REPLICA_ID = os.getenv("REPLICA_ID", f"{socket.gethostname()}:{os.getpid()}")
+    LEASE_TTL = get_int_env("LEASE_TTL", 120)  # Seconds; must exceed API_TIMEOUT with retries
     
     # Database
     MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
     DATABASE_NAME = os.getenv("DATABASE_NAME", "image_bot")
+    MONGO_MAX_POOL_SIZE = get_int_env("MONGO_MAX_POOL_SIZE", 50)
+    MONGO_MIN_POOL_SIZE = get_int_env("MONGO_MIN_POOL_SIZE", 0)
+    MONGO_TIMEOUT_MS = get_int_env("MONGO_TIMEOUT_MS", 5000)  # Server selection timeout
+    USER_CACHE_SIZE = get_int_env("USER_CACHE_SIZE", 5000)  # Cached user documents
+    USER_CACHE_TTL = get_int_env("USER_CACHE_TTL", 60)  # Seconds before re-reading a user
+    STATS_CACHE_TTL = get_int_env("STATS_CACHE_TTL", 60)  # Seconds to reuse /stats results
+    COUNTER_RECONCILE_INTERVAL = get_int_env("COUNTER_RECONCILE_INTERVAL", 3600)  # Seconds
+    DAILY_RESET_TIME = os.getenv("DAILY_RESET_TIME", "00:00")  # HH:MM when daily quotas reset
+    DAILY_RESET_TZ = os.getenv("DAILY_RESET_TZ", "")  # IANA name, e.g. Asia/Kolkata; empty = server time
+    DAILY_RESET_CHUNK = get_int_env("DAILY_RESET_CHUNK", 1000)  # Users reset per update_many
+    DAILY_RESET_RETRY_INTERVAL = get_int_env("DAILY_RESET_RETRY_INTERVAL", 300)  # Seconds between missed-reset checks
+    WRITE_BEHIND = get_bool_env("WRITE_BEHIND", False)  # Batch quota counter writes (single replica)
+    WRITE_BEHIND_INTERVAL_MS = get_int_env("WRITE_BEHIND_INTERVAL_MS", 500)  # Max delay of a write
+    WRITE_BEHIND_MAX_OPS = get_int_env("WRITE_BEHIND_MAX_OPS", 500)  # Flush early after this many changes
+    WRITE_BEHIND_IDLE_TTL = get_int_env("WRITE_BEHIND_IDLE_TTL", 300)  # Seconds to keep idle users' counters
     
     # Required IDs (with validation)
     OWNER_ID = get_int_env("OWNER_ID", 123456789)  # CHANGE DEFAULT TO YOUR ID
     
     # Optional but recommended
     FORCE_JOIN_CHANNEL = os.getenv("FORCE_JOIN_CHANNEL", "")  # Can be empty
+    MEMBERSHIP_CACHE_SIZE = get_int_env("MEMBERSHIP_CACHE_SIZE", 10000)
+    MEMBERSHIP_TTL = get_int_env("MEMBERSHIP_TTL", 600)  # Seconds to trust "is a member"
+    MEMBERSHIP_NEGATIVE_TTL = get_int_env("MEMBERSHIP_NEGATIVE_TTL", 30)  # ... "not a member"
     
     # Convert to int, handle errors
     LOG_GROUP_ID = get_int_env("LOG_GROUP_ID", -1001234567890)
+    LOG_QUEUE_SIZE = get_int_env("LOG_QUEUE_SIZE", 1000)  # Pending log events
+    LOG_FLUSH_INTERVAL = get_float_env("LOG_FLUSH_INTERVAL", 5.0)  # Seconds between batches
+    LOG_OVERFLOW_POLICY = os.getenv("LOG_OVERFLOW_POLICY", "drop_oldest")  # or drop_newest
     
     # API
     API_URL = "https://nsfw.drsudo.workers.dev/?img="
+    API_ENDPOINTS = get_endpoints_env("API_ENDPOINTS", API_URL)  # Prompt is appended to the URL
+    API_ROUTING = os.getenv("API_ROUTING", "least_outstanding")  # or latency
+    API_BACKEND_TYPES = ("http",)  # Keys of image_api.BACKEND_TYPES
+    API_PROBE_INTERVAL = get_int_env("API_PROBE_INTERVAL", 30)  # Seconds between probes of endpoints with a health URL; 0 = off
+    API_POOL_SIZE = get_int_env("API_POOL_SIZE", 20)  # Shared keep-alive connections
+    API_TIMEOUT = get_float_env("API_TIMEOUT", 30.0)  # Read timeout in seconds
+    API_CONNECT_TIMEOUT = get_float_env("API_CONNECT_TIMEOUT", 10.0)
+    API_POOL_TIMEOUT = get_float_env("API_POOL_TIMEOUT", 10.0)  # Wait for a free connection
+    API_MIN_TIMEOUT = get_float_env("API_MIN_TIMEOUT", 5.0)  # Floor for the adaptive read timeout
+    API_TIMEOUT_FACTOR = get_float_env("API_TIMEOUT_FACTOR", 3.0)  # Read timeout = p99 x factor
+    API_ADAPTIVE_SAMPLES = get_int_env("API_ADAPTIVE_SAMPLES", 20)  # Latencies before adapting
+    API_HEDGE = get_bool_env("API_HEDGE", False)  # Second request after the p95 latency
+    API_RETRIES = get_int_env("API_RETRIES", 1)  # Only for connect errors and 429/502/503/504
+    API_RETRY_BACKOFF = get_float_env("API_RETRY_BACKOFF", 0.5)  # Seconds, doubled and jittered
+    API_BREAKER_THRESHOLD = get_int_env("API_BREAKER_THRESHOLD", 5)  # Failures in a row to open
+    API_BREAKER_RECOVERY = get_float_env("API_BREAKER_RECOVERY", 30.0)  # Seconds before a probe
+    
+    # Per-user flood control (checked before any DB or API work)
+    FLOOD_LIMITS = get_mapping_env("FLOOD_LIMITS", "default=1/5,gen=0.2/3,callback=2/5")  # rate/burst
+    FLOOD_ROLE_FACTORS = get_mapping_env("FLOOD_ROLE_FACTORS", "owner=0,admin=0,whitelist=2")  # 0 = unlimited
+    FLOOD_MAX_USERS = get_int_env("FLOOD_MAX_USERS", 10000)  # Tracked (user, command) buckets
+    FLOOD_NOTICE_INTERVAL = get_float_env("FLOOD_NOTICE_INTERVAL", 10.0)  # Seconds between warnings
+    
+    # Generation queue
+    GEN_QUEUE_SIZE = get_int_env("GEN_QUEUE_SIZE", 100)  # Max jobs waiting for a worker
+    GEN_WORKERS = get_int_env("GEN_WORKERS", 4)  # Concurrent upstream calls
+    GEN_MAX_PER_USER = get_int_env("GEN_MAX_PER_USER", 1)  # Queued + running jobs per user
+    GEN_POSITION_UPDATES = get_int_env("GEN_POSITION_UPDATES", 5)  # Edit queue positions only from this one down
+    GEN_GLOBAL_SLOTS = get_int_env("GEN_GLOBAL_SLOTS", 8)  # Upstream calls across replicas
+    
+    # Usage analytics
+    USAGE_EVENTS = get_bool_env("USAGE_EVENTS", True)  # Record every /gen outcome
+    USAGE_QUEUE_SIZE = get_int_env("USAGE_QUEUE_SIZE", 10000)  # Pending events before dropping
+    USAGE_FLUSH_INTERVAL = get_float_env("USAGE_FLUSH_INTERVAL", 5.0)  # Seconds between writes
+    USAGE_BATCH_SIZE = get_int_env("USAGE_BATCH_SIZE", 500)  # Events per insert_many
+    USAGE_RETENTION_DAYS = get_int_env("USAGE_RETENTION_DAYS", 30)  # Raw events; rollups are kept
+    
+    # Outbound Bot API limits
+    OUTBOUND_GLOBAL_RATE = get_float_env("OUTBOUND_GLOBAL_RATE", 30.0)  # Messages per second
+    OUTBOUND_CHAT_RATE = get_float_env("OUTBOUND_CHAT_RATE", 1.0)  # Per private chat
+    OUTBOUND_CHAT_BURST = get_int_env("OUTBOUND_CHAT_BURST", 3)  # Short bursts per chat
+    OUTBOUND_GROUP_RATE = get_float_env("OUTBOUND_GROUP_RATE", 20 / 60)  # Per group/channel
+    OUTBOUND_MAX_RETRIES = get_int_env("OUTBOUND_MAX_RETRIES", 3)  # Retries after RetryAfter
+    
+    # Broadcast
+    BROADCAST_RATE = get_float_env("BROADCAST_RATE", 25.0)  # Messages per second, global
+    BROADCAST_CONCURRENCY = get_int_env("BROADCAST_CONCURRENCY", 10)  # Parallel sends
+    BROADCAST_BATCH_SIZE = get_int_env("BROADCAST_BATCH_SIZE", 200)  # Users per checkpoint
+    BROADCAST_PROGRESS_INTERVAL = get_int_env("BROADCAST_PROGRESS_INTERVAL", 5)  # Seconds
+    
+    # Prompt -> result cache
+    PROMPT_CACHE_SIZE = get_int_env("PROMPT_CACHE_SIZE", 1000)  # In-memory entries
+    PROMPT_CACHE_TTL = get_int_env("PROMPT_CACHE_TTL", 86400)  # Seconds, both tiers
     
     # Validate critical settings
     @classmethod
@@ -41,16 +191,50 @@ class Config:
             errors.append("❌ BOT_TOKEN is missing")
         if not cls.MONGO_URI:
             errors.append("❌ MONGO_URI is missing")
+        if cls.BOT_MODE == "webhook" and not cls.WEBHOOK_SECRET:
+            errors.append("❌ WEBHOOK_SECRET is required in webhook mode")
+        if cls.WRITE_BEHIND and cls.MULTI_REPLICA:
+            print("⚠️  WRITE_BEHIND is ignored in multi-replica mode (counters must be shared)")
+        try:
+            reset_time()
+        except ValueError as e:
+            errors.append(f"❌ Invalid DAILY_RESET_TIME / DAILY_RESET_TZ: {e}")
+        if cls.API_ROUTING not in ("least_outstanding", "latency"):
+            errors.append("❌ API_ROUTING must be least_outstanding or latency")
+        for url, _, kind, _ in cls.API_ENDPOINTS:
+            if kind not in cls.API_BACKEND_TYPES:
+                errors.append(
+                    f"❌ Unknown type '{kind}' for API_ENDPOINTS entry {url} "
+                    f"(use one of: {', '.join(cls.API_BACKEND_TYPES)})"
+                )
         
         print(f"✅ Configuration Loaded:")
         print(f"   Owner ID: {cls.OWNER_ID}")
         print(f"   Log Group: {cls.LOG_GROUP_ID}")
         print(f"   Force Join: {cls.FORCE_JOIN_CHANNEL or 'Disabled'}")
+        print(f"   Mode: {cls.BOT_MODE}")
+        print(f"   Image API: {len(cls.API_ENDPOINTS)} endpoint(s), {cls.API_ROUTING} routing")
         
         if errors:
             print("\n".join(errors))
             return False
         return True
 
+def reset_time():
+    """Configured daily reset as a timezone-aware time (server time if
+    DAILY_RESET_TZ is unset)"""
+    hour, minute = (int(part) for part in Config.DAILY_RESET_TIME.split(":"))
+    try:
+        tz = ZoneInfo(Config.DAILY_RESET_TZ) if Config.DAILY_RESET_TZ else datetime.now().astimezone().tzinfo
+    except Exception:
+        raise ValueError(f"unknown timezone {Config.DAILY_RESET_TZ!r}")
+    return dtime(hour, minute, tzinfo=tz)
+
+def quota_day(now=None):
+    """ISO date of the current quota day; a day starts at DAILY_RESET_TIME"""
+    reset = reset_time()
+    now = now or datetime.now(reset.tzinfo)
+    return (now - timedelta(hours=reset.hour, minutes=reset.minute)).date().isoformat()
+
 # Validate on import
 Config.validate()
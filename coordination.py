@@ -0,0 +1,116 @@
+# coordination.py
+import asyncio
+import logging
+import random
+import uuid
+from pymongo.errors import PyMongoError
+from config import Config
+from database import db_helper
+
+logger = logging.getLogger(__name__)
+
+class Coordinator:
+    def __init__(self, enabled, replica_id, lease_ttl):
+        """Shared state for running several bot replicas against one Mongo.
+
+        When disabled every method is a cheap no-op that always succeeds,
+        so callers don't need to branch on the deployment mode.
+
+        - Leases (TTL documents) cap per-user in-flight jobs and global
+          upstream concurrency across replicas, and make sure a resumed
+          broadcast runs on exactly one replica.
+        - Change streams push cache invalidations between replicas (needs
+          a replica set or Atlas cluster).
+        """
+        self.enabled = enabled
+        self.replica_id = replica_id
+        self.lease_ttl = lease_ttl
+        self._subscriptions = []  # (collection, callback, full_document)
+        self._tasks = []
+
+    # ========================================================================
+    # LEASES
+    # ========================================================================
+
+    def new_holder(self):
+        """Unique holder token for one acquisition"""
+        return f"{self.replica_id}:{uuid.uuid4().hex[:8]}"
+
+    async def acquire(self, name, holder, ttl=None):
+        if not self.enabled:
+            return True
+        return await db_helper.acquire_lease(name, holder, ttl or self.lease_ttl)
+
+    async def release(self, name, holder):
+        if self.enabled:
+            await db_helper.release_lease(name, holder)
+
+    async def acquire_slot(self, prefix, count, ttl=None):
+        """Take one of `count` numbered leases; returns (name, holder) or None"""
+        holder = self.new_holder()
+        if not self.enabled:
+            return prefix, holder
+        slots = list(range(count))
+        random.shuffle(slots)  # Spread replicas over the slots
+        for slot in slots:
+            name = f"{prefix}:{slot}"
+            if await self.acquire(name, holder, ttl):
+                return name, holder
+        return None
+
+    async def wait_for_slot(self, prefix, count, poll=0.25):
+        """Block until one of `count` numbered leases is free"""
+        while True:
+            lease = await self.acquire_slot(prefix, count)
+            if lease:
+                return lease
+            await asyncio.sleep(poll * (0.5 + random.random()))
+
+    # ========================================================================
+    # CACHE INVALIDATION
+    # ========================================================================
+
+    def subscribe(self, collection, callback, full_document=None):
+        """Call callback(change) for every change made by any replica"""
+        self._subscriptions.append((collection, callback, full_document))
+
+    async def start(self):
+        """Start change stream watchers (called from post_init)"""
+        if not self.enabled:
+            return
+        for collection, callback, full_document in self._subscriptions:
+            self._tasks.append(asyncio.create_task(
+                self._watch(collection, callback, full_document)
+            ))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _watch(self, collection, callback, full_document):
+        delay = 1
+        while True:
+            try:
+                async with collection.watch(full_document=full_document) as stream:
+                    delay = 1
+                    async for change in stream:
+                        try:
+                            callback(change)
+                        except Exception as e:
+                            # One odd event must not end invalidation for good
+                            logger.error(f"Change handler for {collection.name} failed: {e}")
+            except PyMongoError as e:
+                logger.warning(f"Change stream on {collection.name} failed: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+# ========================================================================
+# CREATE GLOBAL INSTANCE
+# ========================================================================
+coordinator = Coordinator(
+    enabled=Config.MULTI_REPLICA,
+    replica_id=Config.REPLICA_ID,
+    lease_ttl=Config.LEASE_TTL
+)
@@ -1,33 +1,105 @@
 # database.py
-from pymongo import MongoClient
-from datetime import datetime, timedelta
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError, CollectionInvalid, OperationFailure
+from datetime import datetime, timedelta, timezone
+import logging
 import uuid
-from config import Config
+from cache import TTLCache
+from config import Config, quota_day
+from log_sink import log_sink
+from metrics import MongoCommandListener
+from write_behind import CounterBuffer
+from indexes import INDEXES, index_spec, audited_queries, plan_stages, plan_indexes
 
-# Connect to MongoDB
-client = MongoClient(Config.MONGO_URI)
+# Connect to MongoDB (async driver, connections are opened lazily)
+client = AsyncIOMotorClient(
+    Config.MONGO_URI,
+    maxPoolSize=Config.MONGO_MAX_POOL_SIZE,
+    minPoolSize=Config.MONGO_MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=Config.MONGO_TIMEOUT_MS,
+    event_listeners=[MongoCommandListener()]
+)
 db = client[Config.DATABASE_NAME]
 
+logger = logging.getLogger(__name__)
+
 class Database:
     def __init__(self):
-        """Initialize database collections and indexes"""
+        """Initialize database collections"""
         self.users = db.users
         self.referral_codes = db.referral_codes
         self.credit_codes = db.credit_codes
+        self.prompt_cache = db.prompt_cache
+        self.counters = db.counters
+        self.broadcasts = db.broadcasts
+        self.leases = db.leases
+        self.usage_events = db.usage_events
+        self.usage_rollups = db.usage_rollups
+        self.usage_prompts = db.usage_prompts
+        self.daily_history = db.daily_history
+        
+        # Read-through cache of user documents; every write below invalidates
+        self.user_cache = TTLCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)
+        self.stats_cache = TTLCache(1, Config.STATS_CACHE_TTL)
         
-        # Create indexes
-        self.users.create_index("user_id", unique=True)
-        self.referral_codes.create_index("code", unique=True)
-        self.referral_codes.create_index("expires_at", expireAfterSeconds=0)
-        self.credit_codes.create_index("code", unique=True)
+        # Optional in-memory quota counters, flushed in batches
+        self.write_behind = CounterBuffer(
+            self,
+            enabled=Config.WRITE_BEHIND and not Config.MULTI_REPLICA,
+            interval=Config.WRITE_BEHIND_INTERVAL_MS / 1000,
+            max_ops=Config.WRITE_BEHIND_MAX_OPS,
+            idle_ttl=Config.WRITE_BEHIND_IDLE_TTL
+        )
+
+    async def setup(self):
+        """Startup checks (called once the event loop is running).
+
+        Indexes are not built here: run /indexes migrate (or
+        tools/migrate_indexes.py) after deploying a registry change.
+        """
+        await self._create_usage_events()
+        pending = [
+            f"{collection}.{index}"
+            for collection, index, state in await self.index_status()
+            if state in ("missing", "changed")
+        ]
+        if pending:
+            logger.warning(f"Indexes not migrated: {', '.join(pending)} (run /indexes migrate)")
+
+    async def _create_usage_events(self):
+        """Raw usage events live in a time-series collection (MongoDB 5+)"""
+        try:
+            await self.usage_events.database.create_collection(
+                self.usage_events.name,
+                timeseries={"timeField": "ts", "metaField": "user_id", "granularity": "seconds"},
+                expireAfterSeconds=Config.USAGE_RETENTION_DAYS * 86400
+            )
+        except CollectionInvalid:
+            pass  # Already created
+        except OperationFailure as e:
+            # Older servers: a plain collection with a TTL index does the same job
+            logger.warning(f"Time-series collections unavailable ({e}), using a plain collection")
+            await self.usage_events.create_index(
+                "ts", expireAfterSeconds=Config.USAGE_RETENTION_DAYS * 86400
+            )
 
     # ========================================================================
     # USER METHODS
     # ========================================================================
     
     async def get_user(self, user_id):
-        """Get user document from database"""
-        return self.users.find_one({"user_id": user_id})
+        """Get user document (from the cache when possible)"""
+        user = self.user_cache.get(user_id)
+        if user is None:
+            user = await self.users.find_one({"user_id": user_id})
+            if user is None:
+                return None
+            self.user_cache.set(user_id, user)
+        if self.write_behind.enabled:
+            return self.write_behind.overlay(user)
+        # Callers may modify the result; keep the cached copy intact
+        return dict(user)
 
     async def create_user(self, user_id, username, referrer_id=None):
         """Create new user in database"""
@@ -37,92 +109,132 @@ class Database:
             "role": "user",  # user, admin, whitelist
             "daily_count": 0,
             "total_credits": 20 if referrer_id else 10,
-            "last_reset": datetime.now().date().isoformat(),
             "joined_channels": [],
             "has_claimed_referral": False,  # One-time claim flag
             "created_at": datetime.now()
         }
         if referrer_id:
             user_data["referred_by"] = referrer_id
-        self.users.insert_one(user_data)
+        await self.users.insert_one(user_data)
+        self.user_cache.set(user_id, dict(user_data))
+        await self._count_new_users(1)
         return user_data
 
-    async def update_daily_count(self, user_id):
-        """Increment user's daily image count"""
-        today = datetime.now().date().isoformat()
-        self.users.update_one(
-            {"user_id": user_id, "last_reset": {"$ne": today}},
-            {"$set": {"daily_count": 0, "last_reset": today}}
-        )
-        self.users.update_one(
-            {"user_id": user_id},
-            {"$inc": {"daily_count": 1}}
-        )
+    async def reserve_generation(self, user_id, user=None):
+        """Atomically check the quota and consume one generation.
 
-    async def can_generate(self, user_id):
-        """Check if user can generate an image"""
-        user = await self.get_user(user_id)
-        if not user: 
-            return False, "User not found. Use /start first."
+        The whitelist bypass, credits-before-daily priority and the limit
+        check all run server-side in a single update pipeline, so parallel
+        /gen requests cannot overspend. Daily counts are zeroed by the
+        scheduled rollover (rollover_daily), never here.
+
+        Returns (charge, reason): charge is "whitelist", "credit" or "daily"
+        and must be passed to refund_generation() if delivery fails; on
+        refusal charge is None and reason explains why.
+        
+        In write-behind mode the check runs against the in-memory counters
+        instead; user (the already loaded document) supplies the role.
+        """
+        if self.write_behind.enabled:
+            if user is None:
+                user = await self.get_user(user_id)
+            if user is None:
+                return None, "User not found. Use /start first."
+            return await self.write_behind.reserve(user_id, user.get("role"))
         
-        if user.get("role") == "whitelist":
-            return True, None
-            
-        # Check daily count
-        today = datetime.now().date().isoformat()
-        if user.get("last_reset") != today:
+        before = await self.users.find_one_and_update(
+            {
+                "user_id": user_id,
+                "$or": [
+                    {"role": "whitelist"},
+                    {"total_credits": {"$gt": 0}},
+                    {"daily_count": {"$lt": 10}}
+                ]
+            },
+            [
+                {"$set": {
+                    "total_credits": {"$cond": [
+                        {"$and": [
+                            {"$ne": ["$role", "whitelist"]},
+                            {"$gt": ["$total_credits", 0]}
+                        ]},
+                        {"$subtract": ["$total_credits", 1]},
+                        "$total_credits"
+                    ]},
+                    "daily_count": {"$cond": [
+                        {"$and": [
+                            {"$ne": ["$role", "whitelist"]},
+                            {"$lte": ["$total_credits", 0]}
+                        ]},
+                        {"$add": ["$daily_count", 1]},
+                        "$daily_count"
+                    ]},
+                    "last_active": quota_day()
+                }}
+            ],
+            projection={"role": 1, "total_credits": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        self.user_cache.pop(user_id)
+
+        if before is None:
+            if not await self.users.find_one({"user_id": user_id}, {"_id": 1}):
+                return None, "User not found. Use /start first."
+            return None, "Daily limit reached! Use /refer to earn credits."
+
+        if before.get("role") == "whitelist":
+            return "whitelist", None
+        if before.get("total_credits", 0) > 0:
+            return "credit", None
+        return "daily", None
+
+    async def refund_generation(self, user_id, charge):
+        """Give back a generation reserved by reserve_generation()"""
+        if self.write_behind.enabled:
+            await self.write_behind.refund(user_id, charge)
+        elif charge == "credit":
+            await self.add_credits(user_id, 1)
+        elif charge == "daily":
             await self.users.update_one(
-                {"user_id": user_id},
-                {"$set": {"daily_count": 0, "last_reset": today}}
-            )
-            user["daily_count"] = 0
-            
-        if user["daily_count"] >= 10 and user["total_credits"] <= 0:
-            return False, "Daily limit reached! Use /refer to earn credits."
-            
-        return True, None
-
-    async def use_credit(self, user_id):
-        """Use one credit or increment daily count"""
-        user = await self.get_user(user_id)
-        if user.get("role") == "whitelist":
-            return True
-            
-        if user["total_credits"] > 0:
-            self.users.update_one(
-                {"user_id": user_id},
-                {"$inc": {"total_credits": -1}}
+                {"user_id": user_id, "daily_count": {"$gt": 0}},
+                {"$inc": {"daily_count": -1}}
             )
-        else:
-            await self.update_daily_count(user_id)
-        return True
+            self.user_cache.pop(user_id)
 
     async def add_credits(self, user_id, amount):
         """Add credits to user account"""
-        self.users.update_one(
-            {"user_id": user_id},
-            {"$inc": {"total_credits": amount}}
-        )
+        if self.write_behind.enabled:
+            await self.write_behind.add_credits(user_id, amount)
+        else:
+            await self.users.update_one(
+                {"user_id": user_id},
+                {"$inc": {"total_credits": amount}}
+            )
+        self.user_cache.pop(user_id)
 
-    async def has_user_claimed_referral(self, user_id):
+    async def has_user_claimed_referral(self, user_id, user=None):
         """Check if user has already claimed a referral"""
-        user = await self.get_user(user_id)
+        if user is None:
+            user = await self.get_user(user_id)
         return user and user.get("has_claimed_referral", False)
 
     async def mark_user_claimed_referral(self, user_id):
         """Mark user as having claimed a referral (one-time only)"""
-        self.users.update_one(
+        await self.users.update_one(
             {"user_id": user_id},
             {"$set": {"has_claimed_referral": True}}
         )
+        self.user_cache.pop(user_id)
 
     # ========================================================================
     # ROLE CHECK METHODS
     # ========================================================================
     
-    async def is_admin(self, user_id):
-        """Check if user is admin or owner"""
-        user = await self.get_user(user_id)
+    async def is_admin(self, user_id, user=None):
+        """Check if user is admin or owner (pass the already loaded document
+        as user to skip the lookup)"""
+        if user is None:
+            user = await self.get_user(user_id)
         return user and user.get("role") in ["admin", "whitelist"] if user else False
 
     async def is_owner(self, user_id):
@@ -135,37 +247,283 @@ class Database:
     
     async def add_admin(self, user_id):
         """Add user as admin"""
-        self.users.update_one(
+        result = await self.users.update_one(
             {"user_id": user_id},
             {"$set": {"role": "admin"}},
             upsert=True
         )
+        self.user_cache.pop(user_id)
+        if result.upserted_id is not None:
+            await self._count_new_users(1)
 
     async def remove_admin(self, user_id):
         """Remove admin role"""
-        self.users.update_one(
+        await self.users.update_one(
             {"user_id": user_id},
             {"$set": {"role": "user"}}
         )
+        self.user_cache.pop(user_id)
 
     async def add_whitelist(self, user_id):
         """Add user to whitelist (unlimited generation)"""
-        self.users.update_one(
+        result = await self.users.update_one(
             {"user_id": user_id},
             {"$set": {"role": "whitelist"}},
             upsert=True
         )
+        self.user_cache.pop(user_id)
+        if result.upserted_id is not None:
+            await self._count_new_users(1)
 
     async def remove_whitelist(self, user_id):
         """Remove user from whitelist"""
-        self.users.update_one(
+        await self.users.update_one(
             {"user_id": user_id},
             {"$set": {"role": "user"}}
         )
+        self.user_cache.pop(user_id)
 
     async def get_all_users(self):
         """Get list of all users"""
-        return list(self.users.find({}, {"_id": 0, "user_id": 1, "username": 1, "role": 1}))
+        cursor = self.users.find({}, {"_id": 0, "user_id": 1, "username": 1, "role": 1})
+        return await cursor.to_list(None)
+
+    # ========================================================================
+    # STATISTICS
+    # ========================================================================
+    
+    async def _count_new_users(self, amount):
+        await self.counters.update_one(
+            {"_id": "users"},
+            {"$inc": {"count": amount}},
+            upsert=True
+        )
+
+    async def count_users(self):
+        """Total users from the maintained counter (O(1))"""
+        doc = await self.counters.find_one({"_id": "users"})
+        if doc is None:
+            return await self.reconcile_user_count()
+        return doc["count"]
+
+    async def reconcile_user_count(self):
+        """Reset the user counter from collection metadata (run periodically)"""
+        count = await self.users.estimated_document_count()
+        await self.counters.update_one(
+            {"_id": "users"},
+            {"$set": {"count": count}},
+            upsert=True
+        )
+        return count
+
+    async def record_generation(self):
+        """Count one delivered image in today's counter document"""
+        today = quota_day()
+        await self.counters.update_one(
+            {"_id": f"images:{today}"},
+            {"$inc": {"count": 1}, "$set": {"kind": "images", "date": today}},
+            upsert=True
+        )
+
+    async def get_stats(self):
+        """Bot-wide statistics computed server-side, cached briefly"""
+        stats = self.stats_cache.get("stats")
+        if stats is not None:
+            return stats
+        
+        today = quota_day()
+        
+        # Non-default roles come from the partial role index; everyone else
+        # is a plain user, so no full scan is needed
+        total_users = await self.count_users()
+        roles = {
+            "admin": await self.users.count_documents({"role": "admin"}),
+            "whitelist": await self.users.count_documents({"role": "whitelist"})
+        }
+        roles["user"] = max(total_users - roles["admin"] - roles["whitelist"], 0)
+        
+        images_total = 0
+        images_today = 0
+        async for doc in self.counters.find({"kind": "images"}, {"date": 1, "count": 1}):
+            images_total += doc["count"]
+            if doc["date"] == today:
+                images_today = doc["count"]
+        
+        stats = {
+            "total_users": total_users,
+            "roles": roles,
+            "active_today": await self.users.count_documents({"last_active": today}),
+            "images_total": images_total,
+            "images_today": images_today,
+            "date": today
+        }
+        self.stats_cache.set("stats", stats)
+        return stats
+
+    # ========================================================================
+    # DAILY ROLLOVER
+    # ========================================================================
+    
+    async def get_rollover_day(self):
+        """Quota day the last completed rollover opened (None before the first)"""
+        doc = await self.counters.find_one({"_id": "rollover"})
+        return doc["day"] if doc else None
+
+    async def set_rollover_day(self, day):
+        await self.counters.update_one(
+            {"_id": "rollover"},
+            {"$set": {"day": day, "updated_at": datetime.now()}},
+            upsert=True
+        )
+
+    async def rollover_daily(self, closed_day, new_day, chunk_size):
+        """Archive and zero every non-zero daily_count (the daily reset).
+
+        Walks users with daily_count > 0 in _id order, `chunk_size` at a
+        time: each chunk's counts are saved to daily_history under
+        closed_day, then zeroed with one update_many. History ids are
+        deterministic, so re-running after a crash doesn't double count.
+        Returns the number of users reset.
+        """
+        if self.write_behind.enabled:
+            return await self.write_behind.rollover(closed_day, new_day, chunk_size)
+        return await self._reset_daily_counts(closed_day, new_day, chunk_size)
+
+    async def _reset_daily_counts(self, closed_day, new_day, chunk_size):
+        reset = 0
+        last_id = None
+        while True:
+            query = {"daily_count": {"$gt": 0}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            chunk = await self.users.find(
+                query, {"user_id": 1, "daily_count": 1}
+            ).sort("_id", 1).limit(chunk_size).to_list(None)
+            if not chunk:
+                break
+            last_id = chunk[-1]["_id"]
+
+            try:
+                await self.daily_history.insert_many([
+                    {
+                        "_id": f"{closed_day}:{doc['user_id']}",
+                        "user_id": doc["user_id"],
+                        "day": closed_day,
+                        "count": doc["daily_count"]
+                    }
+                    for doc in chunk
+                ], ordered=False)
+            except BulkWriteError as e:
+                # Duplicates are chunks archived by an interrupted earlier run
+                if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+
+            await self.users.update_many(
+                {"_id": {"$in": [doc["_id"] for doc in chunk]}},
+                {"$set": {"daily_count": 0}}
+            )
+            reset += len(chunk)
+
+        self.user_cache.clear()
+        return reset
+
+    # ========================================================================
+    # USAGE METHODS
+    # ========================================================================
+    
+    async def save_usage(self, events, rollups, prompts):
+        """Insert raw usage events and apply their rollup increments
+        (see usage.rollup_updates for the shapes)"""
+        await self.usage_events.insert_many(events, ordered=False)
+        await self.usage_rollups.bulk_write(
+            [UpdateOne({"_id": _id}, update, upsert=True) for _id, update in rollups.items()],
+            ordered=False
+        )
+        await self.usage_prompts.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": f"{day}:{key}"},
+                    {
+                        "$inc": {"count": count},
+                        "$setOnInsert": {"day": day, "prompt_key": key, "prompt": prompt}
+                    },
+                    upsert=True
+                )
+                for (day, key), (prompt, count) in prompts.items()
+            ],
+            ordered=False
+        )
+    
+    async def get_usage_rollup(self, kind, period):
+        """One hourly ("2024-01-31T13") or daily ("2024-01-31") rollup"""
+        return await self.usage_rollups.find_one({"_id": f"{kind}:{period}"})
+    
+    async def get_top_prompts(self, day, limit=5):
+        """Most generated prompts of a day (reads `limit` index entries)"""
+        cursor = self.usage_prompts.find({"day": day}).sort("count", -1).limit(limit)
+        return [doc async for doc in cursor]
+
+    # ========================================================================
+    # BROADCAST METHODS
+    # ========================================================================
+    
+    async def iter_broadcast_recipients(self, after_user_id, batch_size):
+        """Stream user IDs above after_user_id in order, skipping blocked users"""
+        cursor = self.users.find(
+            {"user_id": {"$gt": after_user_id}, "blocked": {"$ne": True}},
+            {"_id": 0, "user_id": 1}
+        ).sort("user_id", 1).batch_size(batch_size)
+        async for doc in cursor:
+            yield doc["user_id"]
+
+    async def mark_blocked(self, user_id):
+        """Flag a user who blocked the bot so broadcasts skip them"""
+        await self.users.update_one(
+            {"user_id": user_id},
+            {"$set": {"blocked": True}}
+        )
+        self.user_cache.pop(user_id)
+
+    async def unmark_blocked(self, user_id):
+        """Clear the blocked flag when the user talks to the bot again"""
+        await self.users.update_one(
+            {"user_id": user_id},
+            {"$unset": {"blocked": ""}}
+        )
+        self.user_cache.pop(user_id)
+
+    async def create_broadcast(self, data):
+        """Persist a new broadcast so it can be resumed after a restart"""
+        broadcast = {
+            **data,
+            "status": "running",
+            "last_user_id": 0,  # Telegram user IDs are positive
+            "sent": 0,
+            "failed": 0,
+            "blocked": 0,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now()
+        }
+        result = await self.broadcasts.insert_one(broadcast)
+        broadcast["_id"] = result.inserted_id
+        return broadcast
+
+    async def save_broadcast_progress(self, broadcast_id, last_user_id, counts):
+        """Checkpoint a broadcast after a completed batch"""
+        await self.broadcasts.update_one(
+            {"_id": broadcast_id},
+            {"$set": {"last_user_id": last_user_id, "updated_at": datetime.now(), **counts}}
+        )
+
+    async def finish_broadcast(self, broadcast_id, counts):
+        await self.broadcasts.update_one(
+            {"_id": broadcast_id},
+            {"$set": {"status": "done", "updated_at": datetime.now(), **counts}}
+        )
+
+    async def get_running_broadcasts(self):
+        """Broadcasts that were interrupted before finishing"""
+        return await self.broadcasts.find({"status": "running"}).to_list(None)
 
     # ========================================================================
     # REFERRAL METHODS
@@ -176,7 +534,7 @@ class Database:
         code = str(uuid.uuid4())[:8]
         expires_at = datetime.now() + timedelta(minutes=15)
         
-        self.referral_codes.insert_one({
+        await self.referral_codes.insert_one({
             "code": code,
             "generated_by": user_id,
             "used": False,
@@ -185,34 +543,44 @@ class Database:
         })
         return code, expires_at
 
-    async def claim_referral(self, code, user_id):
-        """Claim a referral code (with one-time user check)"""
+    async def claim_referral(self, code, user_id, user=None):
+        """Claim a referral code (with one-time user check; user is the
+        already loaded document, if any)"""
         # Check if user already claimed
-        if await self.has_user_claimed_referral(user_id):
+        if await self.has_user_claimed_referral(user_id, user):
             return False, "You can only claim one referral code in your lifetime!"
         
-        referral = self.referral_codes.find_one({
-            "code": code,
-            "used": False,
-            "expires_at": {"$gt": datetime.now()}
-        })
+        # Take the one-time flag atomically so parallel claims can't both pass
+        result = await self.users.update_one(
+            {"user_id": user_id, "has_claimed_referral": {"$ne": True}},
+            {"$set": {"has_claimed_referral": True}}
+        )
+        self.user_cache.pop(user_id)
+        if result.modified_count == 0:
+            return False, "You can only claim one referral code in your lifetime!"
         
-        if not referral:
-            return False, "Invalid or expired code"
-            
-        # Mark as used
-        self.referral_codes.update_one(
-            {"code": code},
+        # Mark as used only if nobody else got there first
+        referral = await self.referral_codes.find_one_and_update(
+            {
+                "code": code,
+                "used": False,
+                "expires_at": {"$gt": datetime.now()}
+            },
             {"$set": {"used": True, "used_by": user_id}}
         )
         
+        if not referral:
+            await self.users.update_one(
+                {"user_id": user_id},
+                {"$set": {"has_claimed_referral": False}}
+            )
+            self.user_cache.pop(user_id)
+            return False, "Invalid or expired code"
+        
         # Add credits to both users
         await self.add_credits(referral["generated_by"], 20)
         await self.add_credits(user_id, 20)
         
-        # Mark claimant as having claimed
-        await self.mark_user_claimed_referral(user_id)
-        
         return True, "Referral claimed! Both users got 20 credits"
 
     # ========================================================================
@@ -221,7 +589,7 @@ class Database:
     
     async def generate_credit_code(self, code: str, amount: int, generated_by: int):
         """Generate a one-time credit code (Admin/Owner only)"""
-        self.credit_codes.insert_one({
+        await self.credit_codes.insert_one({
             "code": code,
             "amount": amount,
             "generated_by": generated_by,
@@ -232,31 +600,170 @@ class Database:
 
     async def redeem_credit_code(self, code: str, user_id: int):
         """Redeem a credit code and add credits to user"""
-        code_doc = self.credit_codes.find_one({
-            "code": code,
-            "used": False
-        })
+        # Find and mark as used in one step so a code can't be redeemed twice
+        code_doc = await self.credit_codes.find_one_and_update(
+            {"code": code, "used": False},
+            {"$set": {"used": True, "used_by": user_id}}
+        )
         
         if not code_doc:
             return False, "Invalid or already used code"
         
-        # Mark as used
-        self.credit_codes.update_one(
-            {"code": code},
-            {"$set": {"used": True, "used_by": user_id}}
-        )
-        
         # Add credits to user
         await self.add_credits(user_id, code_doc["amount"])
         
         return True, f"{code_doc['amount']} credits added to your account!"
 
+    # ========================================================================
+    # PROMPT CACHE METHODS
+    # ========================================================================
+    
+    async def get_cached_prompt(self, key):
+        """Get an unexpired prompt cache entry"""
+        return await self.prompt_cache.find_one({
+            "_id": key,
+            "expires_at": {"$gt": datetime.now()}
+        })
+
+    async def cache_prompt(self, key, image_url, file_id, ttl):
+        """Store the result of a generation for ttl seconds"""
+        await self.prompt_cache.update_one(
+            {"_id": key},
+            {"$set": {
+                "image_url": image_url,
+                "file_id": file_id,
+                "expires_at": datetime.now() + timedelta(seconds=ttl)
+            }},
+            upsert=True
+        )
+
+    async def delete_cached_prompt(self, key):
+        """Drop a prompt cache entry (e.g. when its file_id stops working)"""
+        await self.prompt_cache.delete_one({"_id": key})
+
+    # ========================================================================
+    # LEASE METHODS (multi-replica coordination)
+    # ========================================================================
+    
+    async def acquire_lease(self, name, holder, ttl):
+        """Take or renew a named lease; False if another holder has it.
+
+        Expiry times are UTC so replicas in different timezones agree.
+        """
+        now = datetime.now(timezone.utc)
+        try:
+            await self.leases.update_one(
+                {
+                    "_id": name,
+                    "$or": [{"expires_at": {"$lte": now}}, {"holder": holder}]
+                },
+                {"$set": {"holder": holder, "expires_at": now + timedelta(seconds=ttl)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # The lease exists, is unexpired and belongs to someone else
+            return False
+        return True
+
+    async def release_lease(self, name, holder):
+        """Give up a lease if we still hold it"""
+        await self.leases.delete_one({"_id": name, "holder": holder})
+
+    # ========================================================================
+    # INDEX METHODS
+    # ========================================================================
+    
+    async def index_status(self):
+        """Compare the server's indexes with the registry in indexes.py.
+
+        Returns (collection, index, state) rows; state is "ok", "missing",
+        "changed" (same name, different definition) or "extra" (not in
+        the registry).
+        """
+        rows = []
+        for collection, models in INDEXES.items():
+            existing = {}
+            async for info in getattr(self, collection).list_indexes():
+                existing[info["name"]] = info
+            existing.pop("_id_", None)
+            for model in models:
+                wanted = model.document
+                info = existing.pop(wanted["name"], None)
+                if info is None:
+                    state = "missing"
+                elif index_spec(info) != index_spec(wanted):
+                    state = "changed"
+                else:
+                    state = "ok"
+                rows.append((collection, wanted["name"], state))
+            rows.extend((collection, index, "extra") for index in existing)
+        return rows
+
+    async def migrate_indexes(self, prune=False):
+        """Make the server's indexes match the registry (safe to re-run).
+
+        Missing indexes are built, changed ones dropped and rebuilt, and
+        indexes not in the registry are dropped only with prune. Returns
+        (collection, index, action) rows; a failure doesn't stop the rest.
+        """
+        await self._create_usage_events()
+        models = {
+            (collection, model.document["name"]): model
+            for collection, collection_models in INDEXES.items()
+            for model in collection_models
+        }
+        rows = []
+        for collection, index, state in await self.index_status():
+            target = getattr(self, collection)
+            action = {"ok": "ok", "missing": "created", "changed": "rebuilt", "extra": "extra"}[state]
+            try:
+                if state == "changed" or (state == "extra" and prune):
+                    await target.drop_index(index)
+                if state in ("missing", "changed"):
+                    await target.create_indexes([models[(collection, index)]])
+                if state == "extra" and prune:
+                    action = "dropped"
+            except OperationFailure as e:
+                action = f"failed: {e.details.get('errmsg', e) if e.details else e}"
+                logger.error(f"Index migration {collection}.{index}: {action}")
+            rows.append((collection, index, action))
+        return rows
+
+    async def audit_queries(self):
+        """explain() every query shape in indexes.audited_queries().
+
+        Returns (method, collection, indexes used, verdict) rows; verdict
+        is "ok", "COLLSCAN", "expected scan" or "no collection" (it doesn't
+        exist yet, so the plan says nothing).
+        """
+        rows = []
+        for method, collection, query, sort, expect_scan in audited_queries():
+            cursor = getattr(self, collection).find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+            plan = plan.get("queryPlan", plan)  # Slot-based engine nests the tree
+            stages = plan_stages(plan)
+            if stages == ["EOF"]:
+                verdict = "no collection"
+            elif "COLLSCAN" in stages:
+                verdict = "expected scan" if expect_scan else "COLLSCAN"
+            else:
+                verdict = "ok"
+            rows.append((method, collection, plan_indexes(plan), verdict))
+        return rows
+
     # ========================================================================
     # LOGGING
     # ========================================================================
     
     async def log_to_group(self, bot, message):
-        """Send log message to private admin group"""
+        """Queue a log message for the private admin group"""
+        if log_sink.running:
+            log_sink.put(message)
+            return
+        
+        # Sink not started (e.g. scripts): send directly
         try:
             await bot.send_message(
                 Config.LOG_GROUP_ID,
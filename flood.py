@@ -0,0 +1,87 @@
+# flood.py
+import logging
+import time
+from collections import OrderedDict
+from config import Config
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+def parse_limit(value):
+    """'rate/burst' -> (rate per second, burst); burst defaults to 1"""
+    rate, _, burst = value.partition("/")
+    return float(rate), int(burst or 1)
+
+class FloodControl:
+    def __init__(self, limits, role_factors, max_users, notice_interval):
+        """Per-user token buckets for each command, kept in a bounded LRU.
+
+        limits maps a command (or "default", "callback", "message") to
+        "rate/burst"; role_factors scales them per role, 0 meaning unlimited.
+        """
+        self.limits = {}
+        for command, value in limits.items():
+            try:
+                self.limits[command] = parse_limit(value)
+            except ValueError:
+                logger.warning(f"Invalid flood limit for {command}: '{value}'")
+        self.limits.setdefault("default", (1.0, 5))
+        self.role_factors = {}
+        for role, value in role_factors.items():
+            try:
+                self.role_factors[role] = float(value)
+            except ValueError:
+                logger.warning(f"Invalid flood factor for {role}: '{value}'")
+        self.max_users = max_users
+        self.notice_interval = notice_interval
+        self._buckets = OrderedDict()  # (user_id, command) -> TokenBucket
+        self._noticed = OrderedDict()  # user_id -> last warning time
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def check(self, user_id, command, role="user"):
+        """Take a token for this update.
+
+        Returns (allowed, notify): notify is True at most once per
+        notice_interval per user so refusals stay cheap.
+        """
+        factor = self.role_factors.get(role, 1.0)
+        if factor == 0:
+            return True, False
+        if command not in self.limits:
+            command = "default"
+
+        key = (user_id, command)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits[command]
+            bucket = TokenBucket(rate * factor, capacity=max(1, round(burst * factor)))
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+
+        if bucket.try_acquire():
+            return True, False
+
+        now = time.monotonic()
+        last = self._noticed.get(user_id)
+        if last is not None and now - last < self.notice_interval:
+            return False, False
+        self._noticed[user_id] = now
+        self._noticed.move_to_end(user_id)
+        if len(self._noticed) > self.max_users:
+            self._noticed.popitem(last=False)
+        return False, True
+
+# ========================================================================
+# CREATE GLOBAL INSTANCE
+# ========================================================================
+flood_control = FloodControl(
+    limits=Config.FLOOD_LIMITS,
+    role_factors=Config.FLOOD_ROLE_FACTORS,
+    max_users=Config.FLOOD_MAX_USERS,
+    notice_interval=Config.FLOOD_NOTICE_INTERVAL
+)
@@ -0,0 +1,457 @@
+# generation.py
+import asyncio
+import logging
+import time
+from datetime import datetime
+from telegram.error import BadRequest, TelegramError
+from cache import TTLCache, prompt_key
+from config import Config
+from ratelimit import PRIORITY_BULK
+from coordination import coordinator
+from database import db_helper
+from image_api import image_api, CircuitOpen
+from usage import usage_recorder
+
+logger = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    """Raised when the generation queue has no free slots"""
+    def __init__(self, waiting):
+        super().__init__(f"Generation queue full ({waiting} waiting)")
+        self.waiting = waiting
+
+class UserBusy(Exception):
+    """Raised when a user already has the maximum number of jobs in flight"""
+
+class GenerationJob:
+    def __init__(self, bot, user, chat_id, message, prompt, charge=None):
+        """A single /gen request waiting for (or holding) a worker.
+
+        charge is the quota reservation from Database.reserve_generation().
+        """
+        self.bot = bot
+        self.user = user
+        self.chat_id = chat_id
+        self.message = message  # The user's /gen message
+        self.prompt = prompt
+        self.key = prompt_key(prompt)
+        self.charge = charge
+        self.status_message = None
+        self.position = 0
+        self.followers = []  # Identical prompts sharing this job's upstream call
+        self.user_lease = None  # (name, holder) per-user slot across replicas
+        self.created = time.monotonic()  # For end-to-end latency in usage events
+        self.answered = False  # Got its image or an error reply
+
+    async def set_status(self, text, rate_limit_args=None):
+        """Edit the queue status message; it is cosmetic, so failures
+        (including 'message is not modified') never stop the job"""
+        try:
+            await self.status_message.edit_text(text, rate_limit_args=rate_limit_args)
+        except BadRequest:
+            pass
+        except TelegramError as e:
+            logger.warning(f"Status update failed: {e}")
+
+    async def refund(self):
+        """Return the reserved generation to the user (at most once)"""
+        if self.charge:
+            charge, self.charge = self.charge, None
+            await db_helper.refund_generation(self.user.id, charge)
+
+class GenerationQueue:
+    def __init__(self, maxsize, workers, per_user_limit, global_slots, position_updates):
+        """Bounded FIFO of generation jobs served by a fixed worker pool.
+
+        In multi-replica mode the per-user limit and the number of upstream
+        calls (global_slots) are also enforced across replicas with leases.
+        Position edits are only sent to the first position_updates jobs.
+        """
+        self.maxsize = maxsize
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.global_slots = global_slots
+        self.position_updates = position_updates
+        self._queue = asyncio.Queue()
+        self._waiting = []  # Jobs not yet picked up, in queue order
+        self._in_flight = {}  # user_id -> queued + running jobs
+        self._by_key = {}  # prompt key -> leader job queued or running
+        self._tasks = []
+        self._running = set()  # Leader jobs currently held by a worker
+        self._edits = set()
+
+    # ========================================================================
+    # SUBMISSION
+    # ========================================================================
+
+    async def submit(self, job):
+        """Reserve a slot, tell the user their position and enqueue the job.
+
+        If the same prompt is already queued or running, the job attaches to
+        that leader instead and gets its result without a second upstream call.
+        """
+        user_id = job.user.id
+        if self._in_flight.get(user_id, 0) >= self.per_user_limit:
+            raise UserBusy()
+
+        # Other replicas may be running this user's jobs too
+        job.user_lease = await coordinator.acquire_slot(f"gen-user:{user_id}", self.per_user_limit)
+        if job.user_lease is None:
+            raise UserBusy()
+
+        leader = self._by_key.get(job.key)
+        if leader is not None:
+            return await self._attach(leader, job)
+
+        if len(self._waiting) >= self.maxsize:
+            await coordinator.release(*job.user_lease)
+            raise QueueFull(len(self._waiting))
+
+        # Reserve before awaiting so concurrent submits see the slot as taken
+        # and same-prompt submits attach to this job
+        self._waiting.append(job)
+        self._in_flight[user_id] = self._in_flight.get(user_id, 0) + 1
+        self._by_key[job.key] = job
+        job.position = len(self._waiting)
+
+        try:
+            job.status_message = await job.message.reply_text(
+                f"⏳ Queued, position {job.position}"
+            )
+        except Exception:
+            self._waiting.remove(job)
+            self._release(user_id)
+            self._by_key.pop(job.key, None)
+            # Followers that attached meanwhile have no leader to serve them
+            for follower in job.followers:
+                self._release(follower.user.id)
+                await report_error(follower, "Leader job could not be queued", log=False)
+            await self._release_leases(None, [job] + job.followers)
+            raise
+
+        self._queue.put_nowait(job)
+        return job.position
+
+    async def _attach(self, leader, job):
+        """Make job wait on leader's upstream call (no queue slot used)"""
+        user_id = job.user.id
+        leader.followers.append(job)
+        self._in_flight[user_id] = self._in_flight.get(user_id, 0) + 1
+
+        # The follower is served by the leader's worker from here on, so a
+        # failed status message must not undo the attachment
+        try:
+            job.status_message = await job.message.reply_text(
+                "⏳ This prompt is already being generated, you'll get it too"
+            )
+        except Exception as e:
+            logger.warning(f"Follower status message failed: {e}")
+        return 0
+
+    def _release(self, user_id):
+        count = self._in_flight.get(user_id, 0) - 1
+        if count > 0:
+            self._in_flight[user_id] = count
+        else:
+            self._in_flight.pop(user_id, None)
+
+    def _announce_positions(self):
+        """Edit status messages of jobs near the front whose position moved.
+
+        Every dequeue moves every job, so editing all of them would cost
+        O(queue size) Bot API calls per job served; jobs further back keep
+        their original position until they get close. The edits are bulk
+        priority so they never delay images and replies.
+        """
+        for position, job in enumerate(self._waiting[:self.position_updates], start=1):
+            if job.position != position and job.status_message:
+                job.position = position
+                task = asyncio.create_task(job.set_status(
+                    f"⏳ Queued, position {position}",
+                    rate_limit_args={"priority": PRIORITY_BULK}
+                ))
+                self._edits.add(task)
+                task.add_done_callback(self._edits.discard)
+
+    # ========================================================================
+    # WORKERS
+    # ========================================================================
+
+    async def start(self):
+        """Start the worker pool (called from post_init)"""
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        """Cancel workers, then refund and notify every queued or running job"""
+        # Taken first: cancelled workers forget their job on the way out
+        unfinished = self._waiting + list(self._running)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+        self._waiting.clear()
+        self._running.clear()
+        self._by_key.clear()
+        self._queue = asyncio.Queue()
+        for job in unfinished:
+            for waiter in [job] + job.followers:
+                if not waiter.answered:
+                    await report_interrupted(waiter)
+
+    def depth(self):
+        """Number of jobs waiting for a worker"""
+        return len(self._waiting)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            self._waiting.remove(job)
+            self._running.add(job)
+            self._announce_positions()
+            slot = None
+            try:
+                # Cap concurrent upstream calls across all replicas
+                slot = await coordinator.wait_for_slot("gen-slot", self.global_slots)
+                await run_generation(job)
+            except Exception as e:
+                logger.error(f"Generation worker error: {e}")
+                await self._fail_unanswered(job, e)
+            finally:
+                self._running.discard(job)
+                # No await between the last delivery and here, so no follower
+                # can attach to the leader without being served
+                if self._by_key.get(job.key) is job:
+                    del self._by_key[job.key]
+                waiters = [job] + job.followers
+                for waiter in waiters:
+                    self._release(waiter.user.id)
+                self._queue.task_done()
+                await self._release_leases(slot, waiters)
+
+    async def _fail_unanswered(self, job, error):
+        """Refund and tell everyone sharing job who has no answer yet"""
+        index = -1
+        # Followers can still attach until the worker's finally block
+        while index < len(job.followers):
+            waiter = job if index < 0 else job.followers[index]
+            index += 1
+            if waiter.answered:
+                continue
+            try:
+                await report_error(waiter, error, log=waiter is job)
+            except Exception as e:
+                logger.warning(f"Error report failed: {e}")
+
+    async def _release_leases(self, slot, waiters):
+        try:
+            if slot:
+                await coordinator.release(*slot)
+            for waiter in waiters:
+                if waiter.user_lease:
+                    await coordinator.release(*waiter.user_lease)
+        except Exception as e:
+            # Unreleased leases simply expire after LEASE_TTL
+            logger.warning(f"Lease release failed: {e}")
+
+# ========================================================================
+# PROMPT CACHE
+# ========================================================================
+
+class PromptCache:
+    def __init__(self, maxsize, ttl):
+        """Prompt -> result cache: in-process LRU in front of a Mongo tier"""
+        self.memory = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+
+    async def get(self, key):
+        """Return {"image_url", "file_id"} for a cached prompt, or None"""
+        entry = self.memory.get(key)
+        if entry is not None:
+            return entry
+
+        try:
+            doc = await db_helper.get_cached_prompt(key)
+        except Exception as e:
+            logger.warning(f"Prompt cache lookup failed: {e}")
+            return None
+        if not doc:
+            return None
+
+        entry = {"image_url": doc["image_url"], "file_id": doc.get("file_id")}
+        remaining = (doc["expires_at"] - datetime.now()).total_seconds()
+        self.memory.set(key, entry, ttl=remaining)
+        return entry
+
+    async def put(self, key, image_url, file_id):
+        """Store a fresh result in both tiers"""
+        self.memory.set(key, {"image_url": image_url, "file_id": file_id})
+        try:
+            await db_helper.cache_prompt(key, image_url, file_id, self.ttl)
+        except Exception as e:
+            logger.warning(f"Prompt cache store failed: {e}")
+
+    async def invalidate(self, key):
+        """Forget a prompt in both tiers"""
+        self.memory.pop(key)
+        try:
+            await db_helper.delete_cached_prompt(key)
+        except Exception as e:
+            logger.warning(f"Prompt cache invalidate failed: {e}")
+
+# ========================================================================
+# JOB EXECUTION
+# ========================================================================
+
+async def deliver(job, photo, image_url, source="miss"):
+    """Send the image and log it; returns the sent message.
+
+    The user was charged when the job was reserved; the charge is kept.
+    """
+    user = job.user
+
+    # Send image
+    message = await job.bot.send_photo(
+        chat_id=job.chat_id,
+        photo=photo,
+        caption=f"✅ <b>Generated!</b>\n\nPrompt: <code>{job.prompt}</code>",
+        parse_mode="HTML"
+    )
+    job.answered = True
+
+    # Cache hits and shared results are charged like fresh ones
+    job.charge = None
+    usage_recorder.record(job, source, "none" if source == "hit" else "success")
+    # Only a statistic: the image is already delivered, so never fail on it
+    try:
+        await db_helper.record_generation()
+    except Exception as e:
+        logger.warning(f"Image counter update failed: {e}")
+
+    # Log to group
+    await db_helper.log_to_group(
+        job.bot,
+        f"#ImageGenerated\n"
+        f"User: {user.mention_html()}\n"
+        f"ID: {user.id}\n"
+        f"Prompt: {job.prompt}\n"
+        f"URL: {image_url}\n"
+        f"Cache: {source}"
+    )
+    return message
+
+async def serve_cached(job):
+    """Answer a job from the prompt cache without an upstream call.
+
+    Returns False on a miss or when the cached file_id no longer works, in
+    which case the job should be queued for a fresh generation.
+    """
+    entry = await prompt_cache.get(job.key)
+    if not entry:
+        return False
+
+    try:
+        await deliver(job, entry["file_id"] or entry["image_url"], entry["image_url"], source="hit")
+    except BadRequest as e:
+        logger.warning(f"Cached result for {job.key} rejected: {e}")
+        await prompt_cache.invalidate(job.key)
+        return False
+    return True
+
+def unavailable_text(retry_in):
+    """Reply used while the image API circuit breaker is open"""
+    minutes = max(1, round(retry_in / 60))
+    return (
+        "🛠 The image service is having trouble right now. "
+        f"Your generation was not charged, please try again in about {minutes} min."
+    )
+
+async def report_error(job, error, log=True):
+    """Refund the job, tell the user generation failed and optionally log it"""
+    job.answered = True
+    await job.refund()
+    usage_recorder.record(job, "miss", "unavailable" if isinstance(error, CircuitOpen) else "error")
+    if isinstance(error, CircuitOpen):
+        # Expected while upstream is down; the breaker already logged the trip
+        try:
+            await job.message.reply_text(unavailable_text(error.retry_in))
+        except Exception as e:
+            logger.warning(f"Error reply failed: {e}")
+        return
+
+    logger.error(f"Generation error: {error}")
+    try:
+        await job.message.reply_text("❌ Error generating image.")
+    except Exception as e:
+        logger.warning(f"Error reply failed: {e}")
+    if log:
+        await db_helper.log_to_group(
+            job.bot,
+            f"#Error\nUser: {job.user.id}\nError: {str(error)}"
+        )
+
+async def report_interrupted(job):
+    """Refund a job the bot is shutting down on and ask the user to retry"""
+    job.answered = True
+    try:
+        await job.refund()
+        usage_recorder.record(job, "miss", "error")
+        await job.message.reply_text(
+            "🛠 The bot is restarting. Your generation was not charged, please try again in a minute."
+        )
+    except Exception as e:
+        logger.warning(f"Interrupted job {job.key} not notified: {e}")
+
+async def run_generation(job):
+    """Call the image API once and deliver the result to the job and to every
+    follower that attached to the same prompt while it was in flight"""
+    await job.set_status("🎨 Generating image...")
+
+    error = None
+    try:
+        # Call API
+        image_url = await image_api.generate(job.prompt)
+    except Exception as e:
+        image_url = None
+        error = e
+
+    photo = image_url
+    index = -1
+    # Followers may keep attaching while earlier waiters are being served
+    while index < len(job.followers):
+        waiter = job if index < 0 else job.followers[index]
+        index += 1
+
+        try:
+            if error:
+                await report_error(waiter, error, log=waiter is job)
+            elif not image_url:
+                waiter.answered = True
+                await waiter.refund()
+                usage_recorder.record(waiter, "miss", "failed")
+                await waiter.message.reply_text("❌ Generation failed. Try again.")
+            else:
+                source = "miss" if waiter is job else "shared"
+                message = await deliver(waiter, photo, image_url, source=source)
+                # Reuse the uploaded file for followers and later cache hits
+                if photo == image_url and message.photo:
+                    photo = message.photo[-1].file_id
+                    await prompt_cache.put(job.key, image_url, photo)
+        except Exception as e:
+            await report_error(waiter, e)
+
+# ========================================================================
+# CREATE GLOBAL INSTANCES
+# ========================================================================
+prompt_cache = PromptCache(
+    maxsize=Config.PROMPT_CACHE_SIZE,
+    ttl=Config.PROMPT_CACHE_TTL
+)
+generation_queue = GenerationQueue(
+    maxsize=Config.GEN_QUEUE_SIZE,
+    workers=Config.GEN_WORKERS,
+    per_user_limit=Config.GEN_MAX_PER_USER,
+    global_slots=Config.GEN_GLOBAL_SLOTS,
+    position_updates=Config.GEN_POSITION_UPDATES
+)
@@ -0,0 +1,412 @@
+# image_api.py
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from urllib.parse import quote
+import httpx
+from config import Config
+from metrics import upstream_latency, upstream_status, upstream_retries, upstream_hedges
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying: the request was refused or never processed
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+class CircuitOpen(Exception):
+    """Raised without calling upstream while the circuit breaker is open"""
+
+    def __init__(self, retry_in):
+        super().__init__(f"Image API unavailable, retry in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+class UpstreamError(Exception):
+    """Upstream answered with an error status or an unreadable body"""
+
+    def __init__(self, status_code, retryable=False):
+        super().__init__(f"Image API returned HTTP {status_code}")
+        self.status_code = status_code
+        self.retryable = retryable
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold, recovery_time, name="Image API"):
+        """Opens after `threshold` failed calls in a row; after `recovery_time`
+        seconds a single probe call decides whether to close again"""
+        self.name = name
+        self.threshold = threshold
+        self.recovery_time = recovery_time
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def retry_in(self):
+        """Seconds until an open breaker lets a probe through"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.recovery_time - time.monotonic())
+
+    def available(self):
+        """Whether a call would be let through, without claiming the probe"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return self.retry_in() == 0
+        return not self._probing
+
+    def allow(self):
+        """Claim permission for one call"""
+        if self.state == self.OPEN:
+            if self.retry_in() > 0:
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"{self.name} circuit closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+                logger.warning(f"{self.name} circuit opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def record_probe(self, healthy):
+        """Health probe result: a healthy open endpoint gets a trial call early,
+        an unhealthy one counts a failure even without user traffic"""
+        if not healthy:
+            self.record_failure()
+        elif self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+            self._probing = False
+
+    def abandon(self):
+        """A call was cancelled before it had an outcome"""
+        self._probing = False
+
+class LatencyWindow:
+    def __init__(self, size=200):
+        """Latencies of the most recent upstream responses"""
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, q):
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+# ========================================================================
+# BACKENDS
+# ========================================================================
+
+class ImageBackend:
+    """One image provider endpoint.
+
+    Subclasses implement _generate(prompt) -> image URL or None and
+    probe() -> bool or None; the base class does breaker, latency and load
+    accounting.
+    """
+
+    def __init__(self, name, weight=1.0):
+        self.name = name
+        self.weight = weight
+        self.breaker = CircuitBreaker(Config.API_BREAKER_THRESHOLD, Config.API_BREAKER_RECOVERY, name)
+        self.latencies = LatencyWindow()
+        self.outstanding = 0
+
+    def _adaptive(self):
+        return len(self.latencies) >= Config.API_ADAPTIVE_SAMPLES
+
+    def read_timeout(self):
+        """p99 latency times a safety factor, clamped to the configured range"""
+        if not self._adaptive():
+            return Config.API_TIMEOUT
+        timeout = self.latencies.percentile(0.99) * Config.API_TIMEOUT_FACTOR
+        return min(Config.API_TIMEOUT, max(Config.API_MIN_TIMEOUT, timeout))
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging a call to this backend, or None"""
+        if not Config.API_HEDGE or not self._adaptive():
+            return None
+        if self.breaker.state != CircuitBreaker.CLOSED:
+            return None  # Don't double the load on a struggling upstream
+        return self.latencies.percentile(0.95)
+
+    def score(self, routing):
+        """Lower is better; outstanding requests are spread by weight"""
+        load = (self.outstanding + 1) / self.weight
+        if routing == "latency" and len(self.latencies):
+            return load * self.latencies.percentile(0.5)
+        return load
+
+    def status(self):
+        return {
+            "endpoint": self.name,
+            "weight": self.weight,
+            "state": self.breaker.state,
+            "failures": self.breaker.failures,
+            "trips": self.breaker.trips,
+            "retry_in": self.breaker.retry_in(),
+            "outstanding": self.outstanding,
+            "timeout": self.read_timeout(),
+            "hedge_delay": self.hedge_delay()
+        }
+
+    async def generate(self, prompt):
+        """Call the provider through this endpoint's circuit breaker.
+
+        Raises CircuitOpen without calling upstream while the breaker is open.
+        """
+        if not self.breaker.allow():
+            upstream_status.inc(endpoint=self.name, status="rejected")
+            raise CircuitOpen(self.breaker.retry_in())
+
+        status = "error"
+        succeeded = None
+        self.outstanding += 1
+        start = time.perf_counter()
+        try:
+            result = await self._generate(prompt)
+            elapsed = time.perf_counter() - start
+            self.latencies.add(elapsed)
+            upstream_latency.observe(elapsed, endpoint=self.name)
+            status = "success" if result else "failed"
+            succeeded = True
+            return result
+        except UpstreamError as e:
+            status = str(e.status_code)
+            succeeded = False
+            raise
+        except httpx.TimeoutException:
+            status = "timeout"
+            succeeded = False
+            raise
+        except Exception:
+            succeeded = False
+            raise
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            self.outstanding -= 1
+            upstream_status.inc(endpoint=self.name, status=status)
+            if succeeded is None:
+                self.breaker.abandon()
+            elif succeeded:
+                self.breaker.record_success()
+            else:
+                upstream_latency.observe(time.perf_counter() - start, endpoint=self.name)
+                self.breaker.record_failure()
+
+    async def _generate(self, prompt):
+        raise NotImplementedError
+
+    async def probe(self):
+        """True if healthy, False if not, None if this backend isn't probed"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class HTTPBackend(ImageBackend):
+    def __init__(self, url, weight=1.0, health_url=None):
+        """GET {url}{prompt}, answered with {"status": "success", "image_link": ...}.
+
+        Only probed if health_url is set: the endpoint itself can't be hit
+        without starting a generation.
+        """
+        super().__init__(url, weight)
+        self.url = url
+        self.health_url = health_url
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=Config.API_POOL_SIZE,
+                    max_keepalive_connections=Config.API_POOL_SIZE
+                ),
+                timeout=httpx.Timeout(
+                    Config.API_TIMEOUT,
+                    connect=Config.API_CONNECT_TIMEOUT,
+                    pool=Config.API_POOL_TIMEOUT
+                )
+            )
+        return self._client
+
+    async def _generate(self, prompt):
+        response = await self._get_client().get(
+            f"{self.url}{quote(prompt, safe='')}",
+            timeout=httpx.Timeout(
+                self.read_timeout(),
+                connect=Config.API_CONNECT_TIMEOUT,
+                pool=Config.API_POOL_TIMEOUT
+            )
+        )
+        if response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES:
+            raise UpstreamError(response.status_code, response.status_code in RETRYABLE_STATUSES)
+        try:
+            data = response.json()
+        except ValueError:
+            raise UpstreamError(response.status_code)
+
+        if data.get("status") != "success":
+            return None
+        return data["image_link"].strip()
+
+    async def probe(self):
+        """Cheap reachability check: the health URL must answer without a 5xx"""
+        if not self.health_url:
+            return None
+        try:
+            response = await self._get_client().get(self.health_url, timeout=Config.API_CONNECT_TIMEOUT)
+        except httpx.HTTPError:
+            return False
+        return response.status_code < 500
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+# Provider types usable in API_ENDPOINTS ("url|weight|type|health_url")
+BACKEND_TYPES = {
+    "http": HTTPBackend
+}
+
+# ========================================================================
+# BACKEND POOL
+# ========================================================================
+
+class BackendPool:
+    def __init__(self, endpoints, routing):
+        """Route generations across endpoints: (url, weight, type, health_url) tuples"""
+        unknown = sorted({kind for _, _, kind, _ in endpoints if kind not in BACKEND_TYPES})
+        if unknown:
+            raise ValueError(f"Unknown API_ENDPOINTS type(s): {', '.join(unknown)}")
+        self.routing = routing
+        self.backends = [
+            BACKEND_TYPES[kind](url, weight, health_url) for url, weight, kind, health_url in endpoints
+        ]
+
+    def available(self):
+        """False while every endpoint's circuit breaker is rejecting calls"""
+        return any(backend.breaker.available() for backend in self.backends)
+
+    def retry_in(self):
+        """Seconds until some endpoint accepts calls again"""
+        return min(backend.breaker.retry_in() for backend in self.backends)
+
+    def status(self):
+        """Per-endpoint breaker, load and timeout details for admins"""
+        return [backend.status() for backend in self.backends]
+
+    def pick(self, exclude=()):
+        """Best available endpoint, preferring ones not in exclude"""
+        candidates = [b for b in self.backends if b.breaker.available()]
+        fresh = [b for b in candidates if b not in exclude]
+        if not (fresh or candidates):
+            return None
+        # Random tie-break so idle endpoints share light traffic
+        return min(fresh or candidates, key=lambda backend: (backend.score(self.routing), random.random()))
+
+    async def generate(self, prompt):
+        """Generate an image and return its URL, or None if the API reports failure.
+
+        Raises CircuitOpen when no endpoint is accepting calls.
+        """
+        tried = []
+        for attempt in range(Config.API_RETRIES + 1):
+            backend = self.pick(exclude=tried)
+            if backend is None:
+                upstream_status.inc(endpoint="pool", status="rejected")
+                raise CircuitOpen(self.retry_in())
+            tried.append(backend)
+            try:
+                return await self._hedged(backend, prompt, tried)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, UpstreamError, CircuitOpen) as e:
+                # Retry only failures where upstream never did the work
+                retryable = not isinstance(e, UpstreamError) or e.retryable
+                if not retryable or attempt >= Config.API_RETRIES:
+                    raise
+                delay = Config.API_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning(f"{backend.name} attempt {attempt + 1} failed ({e!r}), retrying in {delay:.1f}s")
+                upstream_retries.inc(endpoint=backend.name)
+                await asyncio.sleep(delay)
+
+    async def _hedged(self, backend, prompt, tried):
+        """Race a second request, on another endpoint if possible, against
+        one slower than the endpoint's usual p95"""
+        delay = backend.hedge_delay()
+        if delay is None:
+            return await backend.generate(prompt)
+
+        tasks = {asyncio.create_task(backend.generate(prompt))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                hedge = self.pick(exclude=tried) or backend
+                upstream_hedges.inc(endpoint=hedge.name)
+                tasks.add(asyncio.create_task(hedge.generate(prompt)))
+
+            error = None
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def probe_all(self):
+        """Probe every endpoint that has a health check; failures eject,
+        successes re-admit early. The rest rely on their breaker alone."""
+        results = await asyncio.gather(
+            *(backend.probe() for backend in self.backends),
+            return_exceptions=True
+        )
+        for backend, healthy in zip(self.backends, results):
+            if healthy is None:
+                continue
+            healthy = healthy is True
+            if not healthy:
+                logger.warning(f"Health probe failed for {backend.name}")
+            backend.breaker.record_probe(healthy)
+
+    async def close(self):
+        """Close pooled connections (called on application shutdown)"""
+        for backend in self.backends:
+            await backend.close()
+
+# ========================================================================
+# CREATE GLOBAL INSTANCE
+# ========================================================================
+image_api = BackendPool(Config.API_ENDPOINTS, Config.API_ROUTING)
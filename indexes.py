@@ -0,0 +1,112 @@
+# indexes.py
+"""Every MongoDB index the bot relies on, and the queries that use them.
+
+INDEXES is the single source of truth: Database.migrate_indexes() makes
+the server match it, and Database.audit_queries() explains each entry of
+audited_queries() to check that no hot query falls back to a collection
+scan. When you add a query to Database, add its shape below too.
+"""
+from datetime import datetime
+from pymongo import IndexModel
+from config import quota_day
+
+# Options that change what an index does; anything else (v, ns, ...) is ignored
+COMPARED_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+# collection name -> indexes. Names are explicit so renames are deliberate;
+# partial indexes get a key pattern of their own so they can be built next
+# to an older full index on the same field before it is pruned
+INDEXES = {
+    "users": [
+        IndexModel("user_id", name="user_id_1", unique=True),
+        # Only admins and whitelisted users; plain users are counted as the rest
+        IndexModel([("role", 1), ("user_id", 1)], name="role_nondefault",
+                   partialFilterExpression={"role": {"$in": ["admin", "whitelist"]}}),
+        IndexModel("last_active", name="last_active_1"),
+        # Only users the daily rollover has to reset
+        IndexModel([("daily_count", 1), ("_id", 1)], name="daily_count_used",
+                   partialFilterExpression={"daily_count": {"$gt": 0}}),
+    ],
+    "referral_codes": [
+        IndexModel("code", name="code_1", unique=True),
+        IndexModel([("code", 1), ("expires_at", 1)], name="code_unused",
+                   partialFilterExpression={"used": False}),
+        IndexModel("expires_at", name="expires_at_1", expireAfterSeconds=0),
+    ],
+    "credit_codes": [
+        IndexModel("code", name="code_1", unique=True),
+        IndexModel([("code", 1), ("used", 1)], name="code_unused",
+                   partialFilterExpression={"used": False}),
+    ],
+    "prompt_cache": [
+        IndexModel("expires_at", name="expires_at_1", expireAfterSeconds=0),
+    ],
+    "counters": [
+        IndexModel("kind", name="kind_1", sparse=True),
+    ],
+    "broadcasts": [
+        IndexModel("status", name="status_1"),
+    ],
+    "leases": [
+        IndexModel("expires_at", name="expires_at_1", expireAfterSeconds=0),
+    ],
+    "usage_prompts": [
+        IndexModel([("day", 1), ("count", -1)], name="day_1_count_-1"),
+    ],
+    "daily_history": [
+        IndexModel([("user_id", 1), ("day", -1)], name="user_id_1_day_-1"),
+    ],
+}
+# usage_events is a time-series collection whose expiry is a collection
+# option (see Database._create_usage_events), so it isn't listed here
+
+def index_spec(info):
+    """Comparable (key, options) of an IndexModel document or listIndexes entry"""
+    key = tuple((field, int(direction)) for field, direction in info["key"].items())
+    return key, {option: info[option] for option in COMPARED_OPTIONS if option in info}
+
+def audited_queries():
+    """(method, collection, filter, sort, expect_scan) for each Database query.
+
+    Lookups by _id are left out: they always use the _id index.
+    """
+    now = datetime.now()
+    today = quota_day()
+    return [
+        ("get_user", "users", {"user_id": 1}, None, False),
+        ("reserve_generation", "users", {
+            "user_id": 1,
+            "$or": [{"role": "whitelist"}, {"total_credits": {"$gt": 0}}, {"daily_count": {"$lt": 10}}]
+        }, None, False),
+        ("refund_generation", "users", {"user_id": 1, "daily_count": {"$gt": 0}}, None, False),
+        ("claim_referral (flag)", "users", {"user_id": 1, "has_claimed_referral": {"$ne": True}}, None, False),
+        ("get_stats (admins)", "users", {"role": "admin"}, None, False),
+        ("get_stats (whitelist)", "users", {"role": "whitelist"}, None, False),
+        ("get_stats (active)", "users", {"last_active": today}, None, False),
+        ("get_stats (images)", "counters", {"kind": "images"}, None, False),
+        ("rollover_daily", "users", {"daily_count": {"$gt": 0}, "_id": {"$gt": 0}}, [("_id", 1)], False),
+        ("iter_broadcast_recipients", "users",
+         {"user_id": {"$gt": 0}, "blocked": {"$ne": True}}, [("user_id", 1)], False),
+        ("get_running_broadcasts", "broadcasts", {"status": "running"}, None, False),
+        ("claim_referral (code)", "referral_codes",
+         {"code": "x", "used": False, "expires_at": {"$gt": now}}, None, False),
+        ("redeem_credit_code", "credit_codes", {"code": "x", "used": False}, None, False),
+        ("get_top_prompts", "usage_prompts", {"day": today}, [("count", -1)], False),
+        ("get_all_users", "users", {}, None, True),  # Full export, scanning is the point
+    ]
+
+def plan_stages(plan):
+    """All stage names in an explain() winning plan tree"""
+    stages = [plan.get("stage")]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages.extend(plan_stages(child))
+    return [stage for stage in stages if stage]
+
+def plan_indexes(plan):
+    """Index names used by an explain() winning plan tree"""
+    names = [plan["indexName"]] if "indexName" in plan else []
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            names.extend(plan_indexes(child))
+    return names
@@ -0,0 +1,133 @@
+# log_sink.py
+import asyncio
+import logging
+from collections import deque
+from telegram.error import BadRequest
+from config import Config
+from ratelimit import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096  # Telegram's max message length
+SEPARATOR = "\n\n"
+
+class LogSink:
+    def __init__(self, chat_id, maxsize, interval, policy):
+        """Background writer that batches log-group events into few messages.
+
+        Handlers only enqueue. Events are merged into messages under the
+        Telegram length limit and flushed when a message is full or every
+        `interval` seconds. When more than `maxsize` events are pending,
+        policy "drop_oldest" discards the oldest event and "drop_newest"
+        refuses the new one; either way the loss is reported in the group.
+        """
+        self.chat_id = chat_id
+        self.maxsize = maxsize
+        self.interval = interval
+        self.policy = policy
+        self.dropped = 0
+        self._pending = deque()
+        self._pending_chars = 0
+        self._wakeup = asyncio.Event()
+        self._bot = None
+        self._task = None
+        self._stopping = False
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def depth(self):
+        """Number of events waiting to be sent"""
+        return len(self._pending)
+
+    def put(self, text):
+        """Queue an event for the log group (never waits)"""
+        text = text[:MESSAGE_LIMIT - 100]
+        if len(self._pending) >= self.maxsize:
+            self.dropped += 1
+            if self.policy != "drop_oldest":
+                return
+            self._pending_chars -= len(self._pending.popleft()) + len(SEPARATOR)
+        self._pending.append(text)
+        self._pending_chars += len(text) + len(SEPARATOR)
+        if self._pending_chars >= MESSAGE_LIMIT:
+            self._wakeup.set()
+
+    async def start(self, bot):
+        """Start flushing in the background (called from post_init)"""
+        self._bot = bot
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and flush whatever is still pending.
+
+        The loop is asked to finish rather than cancelled: a batch it has
+        already taken off the queue would otherwise never be sent.
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _next_batch(self):
+        """Pop as many events as fit into one message"""
+        parts = []
+        if self.dropped:
+            parts.append(f"⚠️ {self.dropped} log events dropped (queue full)")
+            self.dropped = 0
+        size = sum(len(part) + len(SEPARATOR) for part in parts)
+        while self._pending and size + len(self._pending[0]) <= MESSAGE_LIMIT:
+            text = self._pending.popleft()
+            self._pending_chars -= len(text) + len(SEPARATOR)
+            size += len(text) + len(SEPARATOR)
+            parts.append(text)
+        return SEPARATOR.join(parts)
+
+    async def flush(self):
+        """Send all pending events now"""
+        while self._pending or self.dropped:
+            await self.send(self._next_batch())
+
+    async def send(self, text):
+        try:
+            await self._bot.send_message(
+                self.chat_id,
+                text,
+                parse_mode="HTML",
+                rate_limit_args={"priority": PRIORITY_BULK}
+            )
+        except BadRequest:
+            # One malformed event shouldn't lose the batch; send it as plain text
+            try:
+                await self._bot.send_message(
+                    self.chat_id,
+                    text,
+                    rate_limit_args={"priority": PRIORITY_BULK}
+                )
+            except Exception as e:
+                logger.warning(f"Log failed: {e}")
+        except Exception as e:
+            logger.warning(f"Log failed: {e}")
+
+# ========================================================================
+# CREATE GLOBAL INSTANCE
+# ========================================================================
+log_sink = LogSink(
+    chat_id=Config.LOG_GROUP_ID,
+    maxsize=Config.LOG_QUEUE_SIZE,
+    interval=Config.LOG_FLUSH_INTERVAL,
+    policy=Config.LOG_OVERFLOW_POLICY
+)
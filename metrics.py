@@ -0,0 +1,235 @@
+# metrics.py
+import bisect
+import functools
+import threading
+import time
+from pymongo import monitoring
+from telegram.ext import ApplicationHandlerStop
+
+# Latency buckets in seconds (upper bounds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def bucket_quantile(buckets, counts, q):
+    """Upper bound of the bucket holding the q-quantile (counts has one
+    more entry than buckets, for +Inf)"""
+    target = q * sum(counts)
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= target and count:
+            return buckets[index] if index < len(buckets) else float("inf")
+    return float("inf")
+
+def _key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        """Monotonic counter; safe to use from pymongo's monitoring threads"""
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        """Bucketed distribution, rendered in Prometheus histogram format"""
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}  # key -> [bucket counts..., +Inf count], sum
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._series[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block"""
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+
+    def summary(self, key):
+        """(count, mean, p50, p95, p99) for one label set, or None"""
+        series = self.snapshot().get(key)
+        if not series:
+            return None
+        counts, total = series
+        count = sum(counts)
+        return (
+            count,
+            total / count,
+            self._quantile(counts, 0.50),
+            self._quantile(counts, 0.95),
+            self._quantile(counts, 0.99)
+        )
+
+    def _quantile(self, counts, q):
+        return bucket_quantile(self.buckets, counts, q)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class Gauge:
+    def __init__(self, name, help, labelnames=(), callback=None):
+        """Current value; callback() -> {label values tuple: value} is read at scrape time"""
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.callback = callback
+
+    def values(self):
+        try:
+            return self.callback() if self.callback else {}
+        except Exception:
+            return {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+# ========================================================================
+# METRICS
+# ========================================================================
+registry = Registry()
+
+handler_latency = registry.register(Histogram(
+    "bot_handler_seconds", "Time spent in update handlers", ("handler",)
+))
+handler_errors = registry.register(Counter(
+    "bot_handler_errors_total", "Handler calls that raised", ("handler",)
+))
+upstream_latency = registry.register(Histogram(
+    "bot_upstream_seconds", "Image API request latency", ("endpoint",)
+))
+upstream_status = registry.register(Counter(
+    "bot_upstream_requests_total", "Image API requests by outcome", ("endpoint", "status")
+))
+upstream_retries = registry.register(Counter(
+    "bot_upstream_retries_total", "Image API requests retried after a transient failure", ("endpoint",)
+))
+upstream_hedges = registry.register(Counter(
+    "bot_upstream_hedges_total", "Hedged second requests sent to the image API", ("endpoint",)
+))
+flood_dropped = registry.register(Counter(
+    "bot_flood_dropped_total", "Updates refused by per-user flood control", ("command",)
+))
+mongo_latency = registry.register(Histogram(
+    "bot_mongo_seconds", "MongoDB command latency", ("command",)
+))
+mongo_failures = registry.register(Counter(
+    "bot_mongo_failures_total", "Failed MongoDB commands", ("command",)
+))
+# Filled in by the modules that own the state (see bot.py post_init)
+queue_depth = registry.register(Gauge(
+    "bot_queue_depth", "Items waiting in internal queues", ("queue",)
+))
+upstream_breaker = registry.register(Gauge(
+    "bot_upstream_breaker_open", "Image API circuit breaker (0 closed, 1 half-open, 2 open)", ("endpoint",)
+))
+upstream_outstanding = registry.register(Gauge(
+    "bot_upstream_outstanding", "Image API requests in flight", ("endpoint",)
+))
+cache_stats = registry.register(Gauge(
+    "bot_cache", "Cache hits, misses and size", ("cache", "stat")
+))
+
+def timed(handler):
+    """Decorator recording a handler's latency and errors"""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except ApplicationHandlerStop:
+            raise  # Control flow (e.g. flood_guard refusing an update), not an error
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - start, handler=name)
+    return wrapper
+
+class MongoCommandListener(monitoring.CommandListener):
+    """pymongo listener timing every command (runs in driver threads)"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_latency.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        mongo_latency.observe(event.duration_micros / 1e6, command=event.command_name)
+        mongo_failures.inc(command=event.command_name)
@@ -0,0 +1,148 @@
+# ratelimit.py
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Outbound priorities (lower is served first); pass as
+# rate_limit_args={"priority": PRIORITY_BULK} on bot calls
+PRIORITY_USER = 0
+PRIORITY_BULK = 1
+
+# Bot API methods that count towards the message rate limits
+MESSAGE_ENDPOINTS = ("send", "copyMessage", "forwardMessage", "editMessage")
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        """Allow `rate` operations per second with bursts of up to `capacity`"""
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """Take a token if one is available right now"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        """Wait until a token is available, then take it"""
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Hand out no tokens for `seconds` (e.g. after a flood wait)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+def retry_after_seconds(error):
+    """Seconds to wait from a telegram.error.RetryAfter (int or timedelta)"""
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+class PriorityRateLimiter(BaseRateLimiter):
+    def __init__(self, global_rate, chat_rate, chat_burst, group_rate, max_retries, max_chats=10000):
+        """Outbound scheduler for every Bot API call made by the application.
+
+        Message-sending requests first wait for the target chat's bucket (private chats
+        and groups have separate limits), then for a slot in the global
+        bucket. Global slots go to the lowest priority number first, so user
+        replies overtake queued broadcast and log traffic. On RetryAfter all
+        traffic is paused for the flood wait and the request is retried.
+        """
+        self._global = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._chats = OrderedDict()  # chat_id -> TokenBucket (LRU)
+        self._queue = None
+        self._counter = itertools.count()
+        self._dispatcher = None
+
+    async def initialize(self):
+        if self._dispatcher is not None:
+            return  # Bot and Application both initialize the limiter
+        self._queue = asyncio.PriorityQueue()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = (
+                TokenBucket(self.group_rate, capacity=1) if is_group
+                else TokenBucket(self.chat_rate, capacity=self.chat_burst)
+            )
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _global_slot(self, priority):
+        """Wait for the dispatcher to grant a global token"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._counter), future))
+        await future
+
+    async def _dispatch(self):
+        while True:
+            _, _, future = await self._queue.get()
+            if future.done():
+                continue  # Caller gave up (cancelled)
+            await self._global.acquire()
+            if not future.done():
+                future.set_result(None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get("priority", PRIORITY_USER)
+        chat_id = data.get("chat_id")
+        limited = endpoint.startswith(MESSAGE_ENDPOINTS)
+
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire()
+                await self._global_slot(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                logger.warning(f"Flood wait {delay}s on {endpoint}, retry {attempt + 1}")
+                self._global.pause(delay)
+                await asyncio.sleep(delay)
@@ -0,0 +1,43 @@
+# tools/migrate_indexes.py
+"""Apply the index registry (indexes.py) to the configured database.
+
+Safe to re-run: indexes that already match are left alone. Run it after
+deploying a change to the registry, before the new code takes traffic.
+
+Usage:
+    python tools/migrate_indexes.py            # show what would change
+    python tools/migrate_indexes.py --apply    # build missing/changed indexes
+    python tools/migrate_indexes.py --apply --prune  # also drop unlisted ones
+    python tools/migrate_indexes.py --audit    # explain() every Database query
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+async def main(args):
+    from database import db_helper
+
+    if args.audit:
+        rows = await db_helper.audit_queries()
+        for method, collection, indexes, verdict in rows:
+            print(f"{verdict:14} {collection:15} {method:30} {', '.join(indexes) or '-'}")
+        return 1 if any(row[3] == "COLLSCAN" for row in rows) else 0
+
+    if args.apply:
+        rows = await db_helper.migrate_indexes(prune=args.prune)
+    else:
+        rows = await db_helper.index_status()
+    for collection, index, state in rows:
+        print(f"{state:10} {collection}.{index}")
+    return 1 if any(row[2].startswith("failed") for row in rows) else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--apply", action="store_true", help="create, rebuild (and with --prune drop) indexes")
+    parser.add_argument("--prune", action="store_true", help="drop indexes that are not in the registry")
+    parser.add_argument("--audit", action="store_true", help="report queries that scan whole collections")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,188 @@
+# tools/replica_harness.py
+"""Multi-process contention test for multi-replica mode.
+
+Starts N replica processes against a scratch database. They all race on
+the same users, referral codes, credit codes and generation slots. The
+harness then checks that:
+
+- each user got exactly credits + daily limit generations,
+- each referral code and credit code was used exactly once,
+- no more than --slots generation leases were ever held at once.
+
+Usage:
+    MONGO_URI=mongodb://localhost:27017 python tools/replica_harness.py --replicas 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup_env(database_name):
+    """Point Config at the scratch database before anything imports it"""
+    sys.path.insert(0, ROOT)
+    os.environ["DATABASE_NAME"] = database_name
+    os.environ["MULTI_REPLICA"] = "1"
+    os.environ.setdefault("BOT_TOKEN", "harness")
+
+# ========================================================================
+# REPLICA PROCESS
+# ========================================================================
+
+async def replica_work(index, args):
+    from coordination import Coordinator
+    from database import db_helper
+
+    coordinator = Coordinator(enabled=True, replica_id=f"replica-{index}", lease_ttl=30)
+    results = {"reserved": 0, "referrals": 0, "redeemed": 0}
+
+    async def reserve(user_id):
+        charge, _ = await db_helper.reserve_generation(user_id)
+        if charge:
+            results["reserved"] += 1
+
+    async def claim(code, user_id):
+        success, _ = await db_helper.claim_referral(code, user_id)
+        if success:
+            results["referrals"] += 1
+
+    async def redeem(code, user_id):
+        success, _ = await db_helper.redeem_credit_code(code, user_id)
+        if success:
+            results["redeemed"] += 1
+
+    async def hold_slot():
+        name, holder = await coordinator.wait_for_slot("harness-slot", args.slots, poll=0.01)
+        doc = await db_helper.counters.find_one_and_update(
+            {"_id": "harness-holders"},
+            {"$inc": {"now": 1}},
+            upsert=True,
+            return_document=True
+        )
+        await db_helper.counters.update_one(
+            {"_id": "harness-holders"},
+            {"$max": {"max": doc["now"]}}
+        )
+        await asyncio.sleep(0.01)
+        await db_helper.counters.update_one({"_id": "harness-holders"}, {"$inc": {"now": -1}})
+        await coordinator.release(name, holder)
+
+    tasks = []
+    for user_id in range(1, args.users + 1):
+        tasks += [reserve(user_id) for _ in range(args.attempts)]
+        # Claimants are separate users so referral credits don't skew quotas
+        tasks.append(claim(f"ref-{user_id % args.codes}", args.users + user_id))
+    for code in range(args.codes):
+        tasks += [redeem(f"credit-{code}", 1000 + index) for _ in range(3)]
+    tasks += [hold_slot() for _ in range(args.slot_rounds)]
+    await asyncio.gather(*tasks)
+    return results
+
+def replica_main(index, args, database_name, queue):
+    setup_env(database_name)
+    queue.put(asyncio.run(replica_work(index, args)))
+
+# ========================================================================
+# SETUP AND VERIFICATION
+# ========================================================================
+
+async def prepare(args):
+    from datetime import datetime, timedelta
+    from database import db_helper
+
+    await db_helper.setup()
+    for user_id in range(1, args.users + 1):
+        await db_helper.create_user(user_id, f"user{user_id}")
+        await db_helper.users.update_one(
+            {"user_id": user_id},
+            {"$set": {"total_credits": args.credits}}
+        )
+        await db_helper.create_user(args.users + user_id, f"claimant{user_id}")
+    for code in range(args.codes):
+        await db_helper.referral_codes.insert_one({
+            "code": f"ref-{code}",
+            "generated_by": 0,
+            "used": False,
+            "used_by": None,
+            "expires_at": datetime.now() + timedelta(minutes=15)
+        })
+        await db_helper.generate_credit_code(f"credit-{code}", 5, 0)
+
+async def verify(args, results):
+    from database import db, client, db_helper
+
+    failures = []
+    reserved = sum(r["reserved"] for r in results)
+    expected = args.users * min(args.attempts * args.replicas, args.credits + 10)
+    if reserved != expected:
+        failures.append(f"reserved {reserved} generations, expected {expected}")
+
+    async for user in db_helper.users.find({"user_id": {"$lte": args.users}}):
+        if user["total_credits"] < 0 or user["daily_count"] > 10:
+            failures.append(f"user {user['user_id']} overspent: {user}")
+
+    referrals = sum(r["referrals"] for r in results)
+    if referrals != args.codes:
+        failures.append(f"{referrals} referral claims succeeded, expected {args.codes}")
+
+    redeemed = sum(r["redeemed"] for r in results)
+    if redeemed != args.codes:
+        failures.append(f"{redeemed} credit codes redeemed, expected {args.codes}")
+
+    holders = await db_helper.counters.find_one({"_id": "harness-holders"}) or {}
+    if holders.get("max", 0) > args.slots:
+        failures.append(f"{holders['max']} slot leases held at once, limit {args.slots}")
+
+    print(f"Generations reserved: {reserved}/{expected}")
+    print(f"Referral claims: {referrals}/{args.codes}")
+    print(f"Credit codes redeemed: {redeemed}/{args.codes}")
+    print(f"Max concurrent slot holders: {holders.get('max', 0)}/{args.slots}")
+
+    if not args.keep:
+        await client.drop_database(db.name)
+    return failures
+
+async def run(args, database_name):
+    """Prepare, run the replicas and verify on one event loop (one client)"""
+    await prepare(args)
+
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    processes = [
+        ctx.Process(target=replica_main, args=(i, args, database_name, queue))
+        for i in range(args.replicas)
+    ]
+    for process in processes:
+        process.start()
+    loop = asyncio.get_running_loop()
+    results = [await loop.run_in_executor(None, queue.get) for _ in processes]
+    for process in processes:
+        process.join()
+
+    return await verify(args, results)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--replicas", type=int, default=4)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--attempts", type=int, default=10, help="reservations per user per replica")
+    parser.add_argument("--credits", type=int, default=5)
+    parser.add_argument("--codes", type=int, default=5)
+    parser.add_argument("--slots", type=int, default=3)
+    parser.add_argument("--slot-rounds", type=int, default=30, help="slot acquisitions per replica")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch database")
+    args = parser.parse_args()
+
+    database_name = f"replica_harness_{uuid.uuid4().hex[:8]}"
+    setup_env(database_name)
+    failures = asyncio.run(run(args, database_name))
+    if failures:
+        print("\n".join(f"❌ {failure}" for failure in failures))
+        sys.exit(1)
+    print("✅ Quotas, codes and leases stayed exact across replicas")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# usage.py
+import asyncio
+import bisect
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+from config import Config, quota_day, reset_time
+from database import db_helper
+from metrics import LATENCY_BUCKETS, bucket_quantile
+
+logger = logging.getLogger(__name__)
+
+def rollup_updates(events):
+    """Fold events into $inc documents for the hourly and daily rollups.
+
+    Returns ({rollup _id: update}, {(day, prompt key): (prompt, count)}).
+    Latencies are counted in LATENCY_BUCKETS so percentiles can be read
+    back from a single document. Days are quota days (see quota_day) and
+    hours are in the reset timezone, so a rollup matches the daily reset.
+    """
+    tz = reset_time().tzinfo
+    rollups = {}
+    prompts = {}
+    for event in events:
+        local = event["ts"].astimezone(tz)
+        periods = (("hour", local.strftime("%Y-%m-%dT%H")), ("day", quota_day(local)))
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, event["latency"])
+        for kind, period in periods:
+            update = rollups.setdefault(f"{kind}:{period}", {
+                "$inc": {},
+                "$set": {"kind": kind, "period": period}
+            })
+            inc = update["$inc"]
+            for field in (
+                "total",
+                f"cache.{event['cache']}",
+                f"upstream.{event['upstream']}",
+                f"latency.{bucket}"
+            ):
+                inc[field] = inc.get(field, 0) + 1
+            inc["latency_sum"] = inc.get("latency_sum", 0) + event["latency"]
+
+        key = (periods[1][1], event["prompt_key"])
+        prompt, count = prompts.get(key, (event["prompt"], 0))
+        prompts[key] = (prompt, count + 1)
+    return rollups, prompts
+
+def rollup_summary(doc):
+    """Totals and latency percentiles from one rollup document"""
+    if not doc:
+        return None
+    latency = doc.get("latency", {})
+    counts = [latency.get(str(i), 0) for i in range(len(LATENCY_BUCKETS) + 1)]
+    total = doc.get("total", 0)
+    return {
+        "period": doc["period"],
+        "total": total,
+        "cache": doc.get("cache", {}),
+        "upstream": doc.get("upstream", {}),
+        "avg": doc.get("latency_sum", 0) / total if total else 0.0,
+        "p50": bucket_quantile(LATENCY_BUCKETS, counts, 0.50),
+        "p95": bucket_quantile(LATENCY_BUCKETS, counts, 0.95)
+    }
+
+class UsageRecorder:
+    def __init__(self, enabled, maxsize, interval, batch_size):
+        """Background writer for per-generation usage events.
+
+        record() only appends to memory. Every `interval` seconds, or once
+        `batch_size` events are waiting, the events are inserted in one
+        insert_many and folded into the rollups. Over `maxsize` pending
+        events new ones are dropped and counted.
+        """
+        self.enabled = enabled
+        self.maxsize = maxsize
+        self.interval = interval
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._pending = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def depth(self):
+        """Number of events waiting to be written"""
+        return len(self._pending)
+
+    def record(self, job, cache, upstream):
+        """Queue one /gen outcome (never waits).
+
+        cache is "hit", "miss" or "shared"; upstream is "success", "failed",
+        "error", "unavailable" or "none" when no upstream call was needed.
+        """
+        if not self.enabled:
+            return
+        if len(self._pending) >= self.maxsize:
+            self.dropped += 1
+            return
+        self._pending.append({
+            "ts": datetime.now(timezone.utc),
+            "user_id": job.user.id,
+            "prompt_key": job.key,
+            "prompt": job.prompt,
+            "latency": time.monotonic() - job.created,
+            "cache": cache,
+            "upstream": upstream
+        })
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def start(self):
+        """Start writing in the background (called from post_init)"""
+        if self.enabled:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and write whatever is still pending.
+
+        The loop is asked to finish rather than cancelled, so a batch it is
+        in the middle of writing is not lost.
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write all pending events now"""
+        while self._pending:
+            batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            try:
+                await db_helper.save_usage(batch, *rollup_updates(batch))
+            except Exception as e:
+                # Analytics only: losing a batch must not affect generation
+                logger.error(f"Usage write failed, {len(batch)} events lost: {e}")
+        if self.dropped:
+            logger.warning(f"{self.dropped} usage events dropped (queue full)")
+            self.dropped = 0
+
+# ========================================================================
+# CREATE GLOBAL INSTANCE
+# ========================================================================
+usage_recorder = UsageRecorder(
+    enabled=Config.USAGE_EVENTS,
+    maxsize=Config.USAGE_QUEUE_SIZE,
+    interval=Config.USAGE_FLUSH_INTERVAL,
+    batch_size=Config.USAGE_BATCH_SIZE
+)
@@ -0,0 +1,122 @@
+# webserver.py
+import asyncio
+import hmac
+import logging
+import signal
+from aiohttp import web
+from telegram import Update
+from config import Config
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+class WebServer:
+    def __init__(self, application, host, port, path=None, secret=None):
+        """Embedded HTTP server receiving Telegram webhook updates.
+
+        POST <path>   Telegram update JSON; must carry the secret token header
+        GET /health   Liveness/readiness probe for load balancers
+        GET /metrics  Prometheus metrics
+
+        Without a path it only serves /health and /metrics (polling mode).
+        With a path a secret is required: without one anybody could post
+        forged updates.
+        """
+        if path and not secret:
+            raise ValueError("WEBHOOK_SECRET is required to accept webhook updates")
+        self.application = application
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.app = web.Application()
+        if path:
+            self.app.router.add_post(path, self.handle_update)
+        self.app.router.add_get("/health", self.handle_health)
+        self.app.router.add_get("/metrics", self.handle_metrics)
+        self._runner = None
+
+    async def handle_update(self, request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # Bytes, so a non-ASCII header is a mismatch rather than a TypeError
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        update = Update.de_json(data, self.application.bot)
+        await self.application.update_queue.put(update)
+        return web.Response()
+
+    async def handle_health(self, request):
+        return web.json_response({
+            "status": "ok" if self.application.running else "starting",
+            "pending_updates": self.application.update_queue.qsize()
+        })
+
+    async def handle_metrics(self, request):
+        return web.Response(
+            text=registry.render(),
+            content_type="text/plain",
+            charset="utf-8"
+        )
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def run_webhook(application):
+    """Run the application behind the embedded server until SIGINT/SIGTERM.
+
+    Mirrors Application.run_polling(): initialize, post_init, start, then
+    stop, post_stop, shutdown and post_shutdown on exit.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    server = WebServer(
+        application,
+        Config.WEBHOOK_HOST,
+        Config.PORT,
+        Config.WEBHOOK_PATH,
+        Config.WEBHOOK_SECRET
+    )
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await server.start()
+        await application.start()
+
+        # Every replica may register; Telegram keeps the latest identical URL
+        if Config.WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=f"{Config.WEBHOOK_URL.rstrip('/')}{Config.WEBHOOK_PATH}",
+                secret_token=Config.WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=Config.WEBHOOK_MAX_CONNECTIONS
+            )
+
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,264 @@
+# write_behind.py
+import asyncio
+import logging
+import time
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from config import quota_day
+
+logger = logging.getLogger(__name__)
+
+# Free generations per day (same limit reserve_generation enforces in Mongo)
+DAILY_LIMIT = 10
+
+class CounterBuffer:
+    def __init__(self, database, enabled, interval, max_ops, idle_ttl):
+        """Write-behind buffer for the per-generation quota counters.
+
+        While a user is active, an in-memory view of their total_credits
+        and daily_count is the source of truth for quota checks.
+        Charges and refunds change the view at once and are written as
+        deltas with one bulk_write every `interval` seconds or `max_ops`
+        changes. Views of users idle for `idle_ttl` seconds are dropped once
+        flushed. Only correct when this process is the only writer, so it is
+        disabled in multi-replica mode.
+        """
+        self.database = database
+        self.enabled = enabled
+        self.interval = interval
+        self.max_ops = max_ops
+        self.idle_ttl = idle_ttl
+        self._views = {}  # user_id -> {"credits", "daily", "touched"}
+        self._pending = {}  # user_id -> {"credits", "daily", "active"} not yet written
+        self._ops = 0
+        self._wake = None
+        self._lock = None
+        self._task = None
+        self._stopping = False
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def depth(self):
+        """Users with unwritten counter changes"""
+        return len(self._pending)
+
+    async def start(self):
+        """Start the flush loop (called from post_init)"""
+        if not self.enabled or self._task:
+            return
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the loop and write everything still pending.
+
+        The loop is asked to finish rather than cancelled, so a flush in
+        progress completes (or merges its batch back) before the last one.
+        """
+        if not self._task:
+            return
+        self._stopping = True
+        self._wake.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self.flush()
+        if self._pending:
+            logger.error(f"Counter changes for {len(self._pending)} users could not be written")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+            self._evict()
+
+    # ========================================================================
+    # VIEWS
+    # ========================================================================
+
+    async def _view(self, user_id):
+        """The user's live counters, read from Mongo on first use.
+
+        A user with pending changes always has a view, so a view is never
+        rebuilt from a document that is missing unwritten deltas.
+        """
+        view = self._views.get(user_id)
+        if view is None:
+            doc = await self.database.users.find_one(
+                {"user_id": user_id},
+                {"total_credits": 1, "daily_count": 1}
+            )
+            if doc is None:
+                return None
+            # Another coroutine may have loaded it while we waited
+            view = self._views.setdefault(user_id, {
+                "credits": doc.get("total_credits", 0),
+                "daily": doc.get("daily_count", 0)
+            })
+        view["touched"] = time.monotonic()
+        return view
+
+    def overlay(self, user):
+        """Copy of a user document with unwritten counter changes applied"""
+        if not user:
+            return user
+        # Always a copy: callers may modify it, the cached document must not change
+        user = dict(user)
+        view = self._views.get(user["user_id"])
+        if view is None:
+            return user
+        user.update(total_credits=view["credits"], daily_count=view["daily"])
+        return user
+
+    def _entry(self, user_id):
+        return self._pending.setdefault(user_id, {"credits": 0, "daily": 0, "active": None})
+
+    def _change(self, user_id, view, credits=0, daily=0):
+        view["credits"] += credits
+        view["daily"] += daily
+        entry = self._entry(user_id)
+        entry["credits"] += credits
+        entry["daily"] += daily
+        entry["active"] = quota_day()
+        self._ops += 1
+        if self._ops >= self.max_ops:
+            self._wake.set()
+
+    def _evict(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        for user_id in [u for u, view in self._views.items() if view["touched"] < cutoff]:
+            if user_id not in self._pending:
+                del self._views[user_id]
+
+    # ========================================================================
+    # QUOTA
+    # ========================================================================
+
+    async def reserve(self, user_id, role):
+        """In-memory twin of Database.reserve_generation"""
+        view = await self._view(user_id)
+        if view is None:
+            return None, "User not found. Use /start first."
+        if role == "whitelist":
+            return "whitelist", None
+
+        # No await from here on, so parallel /gen requests can't overspend
+        if view["credits"] > 0:
+            self._change(user_id, view, credits=-1)
+            return "credit", None
+        if view["daily"] < DAILY_LIMIT:
+            self._change(user_id, view, daily=1)
+            return "daily", None
+        return None, "Daily limit reached! Use /refer to earn credits."
+
+    async def refund(self, user_id, charge):
+        """In-memory twin of Database.refund_generation"""
+        view = await self._view(user_id)
+        if view is None:
+            return
+        if charge == "credit":
+            self._change(user_id, view, credits=1)
+        elif charge == "daily" and view["daily"] > 0:
+            self._change(user_id, view, daily=-1)
+
+    async def add_credits(self, user_id, amount):
+        """Credit grants are written through at once (they come from one-time
+        codes, so losing them in a crash is not acceptable) and mirrored in
+        the view"""
+        view = await self._view(user_id)
+        if view is not None:
+            view["credits"] += amount
+        try:
+            await self.database.users.update_one(
+                {"user_id": user_id},
+                {"$inc": {"total_credits": amount}}
+            )
+        except Exception:
+            if view is not None:
+                view["credits"] -= amount
+            raise
+
+    # ========================================================================
+    # FLUSH
+    # ========================================================================
+
+    def _update(self, entry):
+        """Update applying one user's deltas"""
+        return {
+            "$inc": {"total_credits": entry["credits"], "daily_count": entry["daily"]},
+            "$set": {"last_active": entry["active"]}
+        }
+
+    def _merge_back(self, user_id, entry):
+        """Requeue deltas whose write failed, under any newer ones"""
+        current = self._pending.get(user_id)
+        if current is None:
+            self._pending[user_id] = entry
+            return
+        current["credits"] += entry["credits"]
+        current["daily"] += entry["daily"]
+
+    async def flush(self):
+        """Write all pending deltas in one unordered bulk_write"""
+        if not self.enabled:
+            return
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending, self._ops = self._pending, {}, 0
+            users = list(batch)
+
+            failed = set()
+            try:
+                await self.database.users.bulk_write(
+                    [UpdateOne({"user_id": user_id}, self._update(batch[user_id])) for user_id in users],
+                    ordered=False
+                )
+            except BulkWriteError as e:
+                failed = {error["index"] for error in e.details.get("writeErrors", [])}
+                logger.error(f"Counter flush: {len(failed)} of {len(users)} writes failed")
+            except Exception as e:
+                # Unknown outcome; retrying may apply a batch twice, which only
+                # happens if Mongo applied it and the acknowledgement was lost
+                failed = set(range(len(users)))
+                logger.error(f"Counter flush failed, will retry: {e}")
+            except asyncio.CancelledError:
+                # Keep the batch for whoever flushes next (e.g. stop())
+                for user_id in users:
+                    self._merge_back(user_id, batch[user_id])
+                raise
+
+            for index, user_id in enumerate(users):
+                if index in failed:
+                    self._merge_back(user_id, batch[user_id])
+                else:
+                    self.database.user_cache.pop(user_id)
+
+    # ========================================================================
+    # DAILY ROLLOVER
+    # ========================================================================
+
+    async def rollover(self, closed_day, new_day, chunk_size):
+        """Database.rollover_daily with the views kept in step.
+
+        Everything charged before the rollover started is flushed first so it
+        lands in closed_day's history. Flushes are then held off while Mongo
+        is reset; charges made meanwhile stay pending and become the view's
+        new daily count, and are written on top of the zeroed documents.
+        """
+        await self.flush()
+        async with self._lock:
+            reset = await self.database._reset_daily_counts(closed_day, new_day, chunk_size)
+            for user_id, view in self._views.items():
+                entry = self._pending.get(user_id)
+                if entry is not None and entry["daily"] < 0:
+                    entry["daily"] = 0  # Refund of a charge from the closed day
+                view["daily"] = entry["daily"] if entry is not None else 0
+        return reset